@@ -15,26 +15,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
 import math
 import random
 import socket
 import struct
-
-class WBuffer():
-    def __init__(self):
-        self.buffer = []
-        self.position = 0
-    
-    def __bytes__(self):
-        return b''.join(self.buffer)
-    
-    def put_byte(self, byte):
-        self.position += 1
-        self.buffer.append(bytes([byte]))
-    
-    def put_bytes(self, bytes):
-        self.position += len(bytes)
-        self.buffer.append(bytes)
+import threading
 
 class RBuffer():
     def __init__(self, buffer):
@@ -87,6 +73,18 @@ class DNSClass():
 
     ANY = 255       # any class
 
+_local = threading.local()
+
+@functools.lru_cache(maxsize=4096)
+def encode_name(name):
+    labels = []
+    for label in name.split('.'):
+        label = label.strip()
+        if label:
+            label = label.encode('idna')
+            labels.append((label, label.lower()))
+    return tuple(labels)
+
 class DNS():
     MODE_QUERY = 0
     MODE_RESPONSE = 1
@@ -116,6 +114,8 @@ class DNS():
     QUESTION = struct.Struct('! H H')
     POINTER = struct.Struct('! H')
     RECORD = struct.Struct('! H H L H')
+    LENGTH = struct.Struct('! H')
+    SOA = struct.Struct('! L L L L L')
     
     def __init__(self, mode, number=None, headers={}):
         self.mode = mode
@@ -127,32 +127,58 @@ class DNS():
         self.additionals = []
         
     def __bytes__(self):
-        buffer, names = WBuffer(), {}
+        buffer = getattr(_local, 'buffer', None)
+        if buffer is None:
+            buffer = _local.buffer = bytearray()
+        self.pack_into(buffer)
+        return bytes(buffer)
+    
+    def pack_into(self, target, offset=0):
+        if not isinstance(target, bytearray):
+            buffer = getattr(_local, 'buffer', None)
+            if buffer is None:
+                buffer = _local.buffer = bytearray()
+            length = self.pack_into(buffer)
+            if offset + length > len(target):
+                raise ValueError('buffer too small')
+            target[offset:offset + length] = buffer
+            return length
+        del target[offset:]
+        buffer, append, extend, names = target, target.append, target.extend, {}
         def name(name):
-            labels, pointer = [label.strip() for label in name.split('.') if label], None
-            for number, label in enumerate(labels):   
-                name, label = '.'.join(labels[number:]), label.encode('idna')
-                if name in names:
-                    pointer = names[name]
-                    buffer.put_bytes(self.POINTER.pack(pointer | 0xC000))
+            labels, parent = encode_name(name), -1
+            index = len(labels)
+            while index:
+                pointer = names.get((labels[index - 1][1], parent))
+                if pointer is None:
                     break
-                else:
-                    if buffer.position < 0x3FFF:
-                        names[name] = buffer.position
-                    buffer.put_byte(len(label))
-                    buffer.put_bytes(label)
-            if pointer is None:
-                buffer.put_bytes(b'\x00')
+                parent, index = pointer, index - 1
+            positions = []
+            for label, folded in labels[:index]:
+                positions.append(len(buffer) - offset)
+                append(len(label))
+                extend(label)
+            if parent < 0:
+                append(0)
+            else:
+                extend(self.POINTER.pack(parent | 0xC000))
+            for number in range(index - 1, -1, -1):
+                if positions[number] < 0x3FFF:
+                    names[(labels[number][1], parent)] = positions[number]
+                parent = positions[number]
         
         def string(string):
-            buffer.put_bytes(b''.join([struct.pack('! B', len(block)) + block.encode('idna') for block in partition(string, 63)]))
+            for block in partition(string, 63):
+                block = block.encode('idna')
+                append(len(block))
+                extend(block)
         
         def question(qname, qtype, qclass):
             name(qname)
-            buffer.put_bytes(self.QUESTION.pack(qtype, qclass))
+            extend(self.QUESTION.pack(qtype, qclass))
         
         def record_a(rdata):
-            buffer.put_bytes(socket.inet_aton(rdata))
+            extend(socket.inet_aton(rdata))
         
         def record_txt(rdata):
             string(rdata)
@@ -163,32 +189,36 @@ class DNS():
         def record_ns(rdata):
             name(rdata)
         
+        def record_soa(rdata):
+            name(rdata[0])
+            name(rdata[1])
+            extend(self.SOA.pack(*rdata[2:]))
+        
         table = {DNSType.A: record_a, DNSType.TXT: record_txt,
-                 DNSType.CNAME: record_cname, DNSType.NS: record_ns}
+                 DNSType.CNAME: record_cname, DNSType.NS: record_ns,
+                 DNSType.SOA: record_soa}
         
         def record(rname, rtype, rclass, rttl, rdata):
             name(rname)
-            header = len(buffer.buffer)
-            buffer.put_bytes(b'\x00' * 10)
-            position = buffer.position
+            header = len(buffer)
+            extend(self.RECORD.pack(0, 0, 0, 0))
             if rtype in table:
                 table[rtype](rdata)
             else:
-                buffer.put_bytes(rdata)
-            rlength = buffer.position - position
-            buffer.buffer[header] = self.RECORD.pack(rtype, rclass, rttl, rlength)              
+                extend(rdata)
+            self.RECORD.pack_into(buffer, header, rtype, rclass, rttl, len(buffer) - header - self.RECORD.size)
         
-        buffer.put_bytes(self.HEADER.pack(self.number,
-                                          ((self.mode & 1) << 15 |
-                                           (self.headers.get('opcode', 0) & 15) << 11 |
-                                           (self.headers.get('aa', 0) & 1) << 10 |
-                                           (self.headers.get('tc', 0) & 1) << 9 |
-                                           (self.headers.get('rd', 0) & 1) << 8 |
-                                           (self.headers.get('ra', 0) & 1) << 7 |
-                                           (self.headers.get('z', 0) & 7) << 4 |
-                                           (self.headers.get('rcode', 0) & 15)),
-                                          len(self.questions), len(self.answers),
-                                          len(self.authorities), len(self.additionals)))
+        extend(self.HEADER.pack(self.number,
+                                ((self.mode & 1) << 15 |
+                                 (self.headers.get('opcode', 0) & 15) << 11 |
+                                 (self.headers.get('aa', 0) & 1) << 10 |
+                                 (self.headers.get('tc', 0) & 1) << 9 |
+                                 (self.headers.get('rd', 0) & 1) << 8 |
+                                 (self.headers.get('ra', 0) & 1) << 7 |
+                                 (self.headers.get('z', 0) & 7) << 4 |
+                                 (self.headers.get('rcode', 0) & 15)),
+                                len(self.questions), len(self.answers),
+                                len(self.authorities), len(self.additionals)))
         for qname, qtype, qclass in self.questions:
             question(qname, qtype, qclass)
         for rname, rtype, rclass, rttl, rdata in self.answers:
@@ -197,78 +227,121 @@ class DNS():
             record(rname, rtype, rclass, rttl, rdata)
         for rname, rtype, rclass, rttl, rdata in self.additionals:
             record(rname, rtype, rclass, rttl, rdata)
-        return bytes(buffer)
+        return len(buffer) - offset
     
     @classmethod
-    def parse(cls, buffer):
-        def name():
-            size, labels = buffer.get_byte(), []
-            while size:
-                if size & 0xc0 == 0xc0:
-                    position, buffer.position = buffer.position, ((size << 8) | buffer.get_byte()) & ~0xC000
-                    labels.append(name())
-                    buffer.position, size = position + 1, 0
-                else:
-                    labels.append(buffer.get_bytes(size).decode('idna'))
-                    size = buffer.get_byte()
-            return '.'.join(labels)
+    def parse(cls, buffer, offset=0):
+        reader = None
+        if isinstance(buffer, RBuffer):
+            reader, offset, buffer = buffer, buffer.position, buffer.buffer
+        view = memoryview(buffer).cast('B')
+        text = str(view, 'latin1')
+        names, base = {}, offset
+        
+        def label(start, end):
+            value = text[start:end]
+            if not value.isascii() or value[:4].lower() == 'xn--':
+                value = bytes(view[start:end]).decode('idna')
+            return value
+        
+        def name(offset):
+            labels, starts, suffix, end, limit = [], [], None, None, offset
+            while True:
+                if offset in names:
+                    suffix = names[offset] or None
+                    break
+                size = view[offset]
+                if not size:
+                    offset += 1
+                    break
+                if size & 0xC0 == 0xC0:
+                    pointer = base + (((size & 0x3F) << 8) | view[offset + 1])
+                    if end is None:
+                        end = offset + 2
+                    if pointer >= limit:
+                        raise ValueError('invalid compression pointer')
+                    offset = limit = pointer
+                    continue
+                if size & 0xC0:
+                    raise ValueError('invalid label type')
+                starts.append(offset)
+                labels.append(label(offset + 1, offset + 1 + size))
+                offset += 1 + size
+            if end is None:
+                end = offset
+            for start, part in zip(reversed(starts), reversed(labels)):
+                suffix = part if suffix is None else part + '.' + suffix
+                names[start] = suffix
+            return suffix or '', end
         
-        def string(length):
-            size, parts, read = True, [], 0
-            while size and read < length:
-                size = buffer.get_byte()
-                parts.append(buffer.get_bytes(size).decode('idna'))
-                read += size + 1
+        def string(offset, length):
+            parts, end = [], offset + length
+            while offset < end:
+                size = view[offset]
+                if not size:
+                    break
+                parts.append(label(offset + 1, offset + 1 + size))
+                offset += 1 + size
             return ''.join(parts)
         
-        def question():
-            qname = name()
-            qtype, qclass = cls.QUESTION.unpack(buffer.get_bytes(4))
-            return qname, qtype, qclass
+        def record_a(offset, rlength):
+            if rlength != 4:
+                raise ValueError('invalid A record length')
+            return socket.inet_ntoa(view[offset:offset + rlength])
         
-        def record_a(rlength):
-            return socket.inet_ntoa(buffer.get_bytes(rlength))
+        def record_txt(offset, rlength):
+            return string(offset, rlength)
         
-        def record_txt(rlength):
-            return string(rlength)
+        def record_cname(offset, rlength):
+            return name(offset)[0]
         
-        def record_cname(rlength):
-            return name()
+        def record_ns(offset, rlength):
+            return name(offset)[0]
         
-        def record_ns(rlength):
-            return name()
+        def record_soa(offset, rlength):
+            mname, offset = name(offset)
+            rname, offset = name(offset)
+            return (mname, rname) + cls.SOA.unpack_from(view, offset)
         
         table = {DNSType.A: record_a, DNSType.TXT: record_txt,
-                 DNSType.CNAME: record_cname, DNSType.NS: record_ns}
+                 DNSType.CNAME: record_cname, DNSType.NS: record_ns,
+                 DNSType.SOA: record_soa}
         
-        def record():
-            rname = name()
-            rtype, rclass, rttl, rlength = cls.RECORD.unpack(buffer.get_bytes(10))
-            if rtype in table:
-                rdata = table[rtype](rlength)
-            else:
-                rdata = buffer.get_bytes(rlength)
-            return rname, rtype, rclass, rttl, rdata
-                
-        number, flags, qcount, acount, nscount, arcount = cls.HEADER.unpack(buffer.get_bytes(12))
-        mode, opcode, aa, tc, rd, ra, z, rcode = ((flags >> 15) & 1,
-                                                  (flags >> 11) & 15,
-                                                  (flags >> 10) & 1,
-                                                  (flags >> 9) & 1,
-                                                  (flags >> 8) & 1,
-                                                  (flags >> 7) & 1,
-                                                  (flags >> 4) & 7,
-                                                  (flags >> 0) & 15)
-        headers = {'opcode': opcode, 'aa': aa, 'tc': tc, 'rd': rd, 'ra': ra, 'z': z, 'rcode': rcode}
-        dns = DNS(mode, number, headers)
-        for i in range(qcount):
-            dns.questions.append(question())
-        for i in range(acount):
-            dns.answers.append(record())
-        for i in range(nscount):
-            dns.authorities.append(record())
-        for i in range(arcount):
-            dns.additionals.append(record())
+        def records(count, offset, section):
+            for i in range(count):
+                rname, offset = name(offset)
+                rtype, rclass, rttl, rlength = cls.RECORD.unpack_from(view, offset)
+                offset += cls.RECORD.size
+                if offset + rlength > len(view):
+                    raise ValueError('truncated record data')
+                if rtype in table:
+                    rdata = table[rtype](offset, rlength)
+                else:
+                    rdata = bytes(view[offset:offset + rlength])
+                section.append((rname, rtype, rclass, rttl, rdata))
+                offset += rlength
+            return offset
+        
+        try:
+            number, flags, qcount, acount, nscount, arcount = cls.HEADER.unpack_from(view, offset)
+            offset += cls.HEADER.size
+            headers = {'opcode': (flags >> 11) & 15, 'aa': (flags >> 10) & 1, 'tc': (flags >> 9) & 1, 'rd': (flags >> 8) & 1,
+                       'ra': (flags >> 7) & 1, 'z': (flags >> 4) & 7, 'rcode': flags & 15}
+            dns = DNS((flags >> 15) & 1, number, headers)
+            for i in range(qcount):
+                qname, offset = name(offset)
+                qtype, qclass = cls.QUESTION.unpack_from(view, offset)
+                offset += cls.QUESTION.size
+                dns.questions.append((qname, qtype, qclass))
+            offset = records(acount, offset, dns.answers)
+            offset = records(nscount, offset, dns.authorities)
+            offset = records(arcount, offset, dns.additionals)
+        except (IndexError, struct.error):
+            raise ValueError('truncated DNS message')
+        finally:
+            view.release()
+        if reader is not None:
+            reader.position = offset
         return dns
        
     def add_question(self, qname, qtype, qclass):
@@ -292,5 +365,9 @@ class DNSResponse(DNS):
         super().__init__(self.MODE_RESPONSE, number, headers)
 
 def pack_tcp(query):
-    query = bytes(query)
-    return struct.pack('! H', len(query)) + query
\ No newline at end of file
+    if not isinstance(query, DNS):
+        query = bytes(query)
+        return DNS.LENGTH.pack(len(query)) + query
+    buffer = bytearray(DNS.LENGTH.size)
+    DNS.LENGTH.pack_into(buffer, 0, query.pack_into(buffer, DNS.LENGTH.size))
+    return bytes(buffer)
\ No newline at end of file
@@ -0,0 +1,398 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2012, Maximilian Köhl <linuxmaxi@googlemail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import selectors
+import shlex
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from dns import DNS, DNSClass, DNSResponse, DNSType, encode_name
+
+def wire_name(name):
+    return b''.join(bytes((len(label),)) + folded for label, folded in encode_name(name)) + b'\x00'
+
+class Zone():
+    CLASSES = {'IN': DNSClass.IN, 'CS': DNSClass.CS, 'CH': DNSClass.CH, 'HS': DNSClass.HS}
+    
+    def __init__(self, origin, ttl=3600):
+        self.origin = origin.rstrip('.').lower()
+        self.ttl = ttl
+        self.records = {}
+        self.names = {self.origin}
+        self.soa = None
+    
+    def owns(self, name):
+        return name == self.origin or name.endswith('.' + self.origin)
+    
+    def add(self, name, rtype, rttl, rdata, rclass=DNSClass.IN):
+        name = name.rstrip('.')
+        key = name.lower()
+        if not self.owns(key):
+            raise ValueError('{} is outside of zone {}'.format(name, self.origin))
+        record = (name, rtype, rclass, rttl, rdata)
+        self.records.setdefault(key, {}).setdefault(rtype, []).append(record)
+        while key != self.origin:
+            self.names.add(key)
+            key = key.split('.', 1)[1]
+        if rtype == DNSType.SOA:
+            self.soa = record
+    
+    @classmethod
+    def parse(cls, text, origin, ttl=3600):
+        zone = cls(origin, ttl)
+        current, owner, tokens, depth = zone.origin, None, [], 0
+        
+        def absolute(name):
+            if name == '@':
+                return current
+            if name.endswith('.'):
+                return name[:-1]
+            return name + '.' + current
+        
+        rdatas = {DNSType.A: lambda tokens: socket.inet_ntoa(socket.inet_aton(tokens[0])),
+                  DNSType.NS: lambda tokens: absolute(tokens[0]),
+                  DNSType.CNAME: lambda tokens: absolute(tokens[0]),
+                  DNSType.TXT: lambda tokens: ''.join(tokens),
+                  DNSType.SOA: lambda tokens: (absolute(tokens[0]), absolute(tokens[1])) + tuple(map(int, tokens[2:7]))}
+        
+        for number, line in enumerate(text.splitlines(), 1):
+            lexer = shlex.shlex(line, posix=True, punctuation_chars='()')
+            lexer.commenters = ';'
+            lexer.whitespace_split = True
+            if not depth:
+                tokens, inherit = [], line[:1].isspace()
+            for word in lexer:
+                if word and not word.strip('()'):
+                    depth += word.count('(') - word.count(')')
+                else:
+                    tokens.append(word)
+            if depth or not tokens:
+                continue
+            try:
+                if tokens[0] == '$ORIGIN':
+                    current = absolute(tokens[1]).lower()
+                    continue
+                if tokens[0] == '$TTL':
+                    zone.ttl = int(tokens[1])
+                    continue
+                if not inherit:
+                    owner = absolute(tokens.pop(0))
+                if owner is None:
+                    raise ValueError('missing owner name')
+                rttl, rclass = zone.ttl, DNSClass.IN
+                while tokens[0].isdigit() or tokens[0].upper() in cls.CLASSES:
+                    if tokens[0].isdigit():
+                        rttl = int(tokens.pop(0))
+                    else:
+                        rclass = cls.CLASSES[tokens.pop(0).upper()]
+                rtype = getattr(DNSType, tokens.pop(0).upper(), None)
+                if rtype not in rdatas:
+                    raise ValueError('unsupported record type')
+                zone.add(owner, rtype, rttl, rdatas[rtype](tokens), rclass)
+            except (IndexError, ValueError, OSError) as error:
+                raise ValueError('line {}: {}'.format(number, error))
+        return zone
+    
+    @classmethod
+    def load(cls, path, origin, ttl=3600):
+        with open(path) as zonefile:
+            return cls.parse(zonefile.read(), origin, ttl)
+
+class NameServer():
+    UDP_LIMIT = 512
+    TCP_LIMIT = 65535
+    MAX_CHAIN = 8
+    
+    def __init__(self, zones, host='0.0.0.0', port=53, reuseport=False, batch=64, memo_size=65536, timeout=10, max_connections=64):
+        self.zones = {zone.origin: zone for zone in zones}
+        self.host = host
+        self.port = port
+        self.reuseport = reuseport
+        self.batch = batch
+        self.memo_size = memo_size
+        self.timeout = timeout
+        self.running = False
+        self.compiled = {}
+        self.memo = {}
+        self.memo_lock = threading.Lock()
+        self.connections = threading.BoundedSemaphore(max_connections)
+        for zone in zones:
+            for name, rrsets in zone.records.items():
+                for rtype in rrsets:
+                    question = wire_name(name) + DNS.QUESTION.pack(rtype, DNSClass.IN)
+                    self.compiled[question] = self._compile(name, rtype, DNSClass.IN)
+        self.udp = self.tcp = None
+        self.bind()
+    
+    def _socket(self, kind, port):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        sock = socket.socket(family, kind)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuseport:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, port))
+        return sock
+    
+    def bind(self):
+        self.udp = self._socket(socket.SOCK_DGRAM, self.port)
+        self.port = self.udp.getsockname()[1]
+        self.udp.setblocking(False)
+        self.tcp = self._socket(socket.SOCK_STREAM, self.port)
+        self.tcp.listen(128)
+        self.tcp.setblocking(False)
+    
+    def _zone(self, name):
+        while True:
+            if name in self.zones:
+                return self.zones[name]
+            if '.' not in name:
+                return None
+            name = name.split('.', 1)[1]
+    
+    def _compile(self, qname, qtype, qclass):
+        response = DNSResponse(0, {'aa': 1})
+        response.add_question(qname, qtype, qclass)
+        name = qname.lower()
+        zone = self._zone(name)
+        if zone is None or qclass not in (DNSClass.IN, DNSClass.ANY):
+            response.headers = {'rcode': DNS.RCODE_REFUSED}
+        else:
+            records = zone.records.get(name, {})
+            while (records is not None and qtype not in (DNSType.CNAME, DNSType.ALL) and qtype not in records and
+                   DNSType.CNAME in records and len(response.answers) < self.MAX_CHAIN):
+                cname = records[DNSType.CNAME][0]
+                response.answers.append(cname)
+                name = cname[4].lower()
+                records = zone.records.get(name, {}) if zone.owns(name) else None
+            if records is None:
+                pass
+            elif qtype == DNSType.ALL and records:
+                for rrset in records.values():
+                    response.answers.extend(rrset)
+            elif qtype in records:
+                response.answers.extend(records[qtype])
+                if qtype == DNSType.NS:
+                    for rname, rtype, rclass, rttl, rdata in records[qtype]:
+                        glue = zone.records.get(rdata.lower(), {}).get(DNSType.A, [])
+                        response.additionals.extend(glue)
+            else:
+                if name not in zone.names:
+                    response.headers['rcode'] = DNS.RCODE_NAME
+                if zone.soa is not None:
+                    rname, rtype, rclass, rttl, rdata = zone.soa
+                    response.add_authority(rname, rtype, rclass, min(rttl, rdata[-1]), rdata)
+        full = bytes(response)
+        flags = int.from_bytes(full[2:4], 'big')
+        end = DNS.HEADER.size + len(wire_name(qname)) + DNS.QUESTION.size
+        return full, DNS.HEADER.pack(0, flags | 0x0200, 1, 0, 0, 0) + full[DNS.HEADER.size:end]
+    
+    def _error(self, data, rcode):
+        number, flags = int.from_bytes(data[:2], 'big'), int.from_bytes(data[2:4], 'big')
+        return DNS.HEADER.pack(number, 0x8000 | (flags & 0x7900) | rcode, 0, 0, 0, 0)
+    
+    def _lookup(self, data, key, end):
+        labels, offset = [], DNS.HEADER.size
+        while data[offset]:
+            labels.append(str(data[offset + 1:offset + 1 + data[offset]], 'latin1').lower())
+            offset += 1 + data[offset]
+        qtype, qclass = DNS.QUESTION.unpack_from(data, end - DNS.QUESTION.size)
+        try:
+            compiled = self._compile('.'.join(labels), qtype, qclass)
+        except (UnicodeError, ValueError):
+            return None
+        if compiled[0][DNS.HEADER.size:end] != key:
+            return None
+        with self.memo_lock:
+            if len(self.memo) >= self.memo_size:
+                self.memo.pop(next(iter(self.memo)), None)
+            self.memo[key] = compiled
+        return compiled
+    
+    def answer(self, data, limit=UDP_LIMIT):
+        if len(data) < DNS.HEADER.size or data[2] & 0x80:
+            return None
+        number, flags, qcount, acount, nscount, arcount = DNS.HEADER.unpack_from(data)
+        if flags & 0x7800:
+            return self._error(data, DNS.RCODE_IMPLEMENTED)
+        if qcount != 1:
+            return self._error(data, DNS.RCODE_FORMAT)
+        offset = DNS.HEADER.size
+        try:
+            while data[offset]:
+                if data[offset] > 63:
+                    return self._error(data, DNS.RCODE_FORMAT)
+                offset += 1 + data[offset]
+        except IndexError:
+            return self._error(data, DNS.RCODE_FORMAT)
+        end = offset + 1 + DNS.QUESTION.size
+        if end > len(data):
+            return self._error(data, DNS.RCODE_FORMAT)
+        key = data[DNS.HEADER.size:offset + 1].lower() + data[offset + 1:end]
+        compiled = self.compiled.get(key) or self.memo.get(key) or self._lookup(data, key, end)
+        if compiled is None:
+            return self._error(data, DNS.RCODE_FORMAT)
+        message = compiled[0] if len(compiled[0]) <= limit else compiled[1]
+        return b''.join((data[:2], bytes((message[2] | (data[2] & 0x01),)), message[3:DNS.HEADER.size],
+                         data[DNS.HEADER.size:end], message[end:]))
+    
+    def _receive(self):
+        replies = []
+        for number in range(self.batch):
+            try:
+                data, address = self.udp.recvfrom(self.TCP_LIMIT)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                continue
+            try:
+                reply = self.answer(data)
+            except Exception:
+                traceback.print_exc()
+                reply = self._error(data, DNS.RCODE_SERVER)
+            if reply is not None:
+                replies.append((reply, address))
+        for reply, address in replies:
+            try:
+                self.udp.sendto(reply, address)
+            except OSError:
+                pass
+    
+    def _connection(self, connection):
+        with connection:
+            connection.setblocking(True)
+            connection.settimeout(self.timeout)
+            reader = connection.makefile('rb')
+            try:
+                while self.running:
+                    prefix = reader.read(DNS.LENGTH.size)
+                    if len(prefix) < DNS.LENGTH.size:
+                        break
+                    length, = DNS.LENGTH.unpack(prefix)
+                    data = reader.read(length)
+                    if len(data) < length:
+                        break
+                    reply = self.answer(data, self.TCP_LIMIT)
+                    if reply is not None:
+                        connection.sendall(DNS.LENGTH.pack(len(reply)) + reply)
+            except OSError:
+                pass
+            finally:
+                reader.close()
+                self.connections.release()
+    
+    def _accept(self):
+        try:
+            connection, address = self.tcp.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        if not self.connections.acquire(blocking=False):
+            connection.close()
+            return
+        threading.Thread(target=self._connection, args=(connection,), daemon=True).start()
+    
+    def serve_forever(self, interval=0.5):
+        self.running = True
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.udp, selectors.EVENT_READ, self._receive)
+            selector.register(self.tcp, selectors.EVENT_READ, self._accept)
+            while self.running:
+                for key, events in selector.select(interval):
+                    key.data()
+    
+    def shutdown(self):
+        self.running = False
+    
+    def server_close(self):
+        self.udp.close()
+        self.tcp.close()
+
+class Workers():
+    RESTART_DELAY = 1
+    
+    def __init__(self, server, processes=None):
+        self.server = server
+        self.server.reuseport = True
+        self.processes = processes or os.cpu_count() or 1
+        self.children = {}
+        self.running = False
+    
+    def _child(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.server.shutdown())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.server.shutdown())
+        status = 0
+        try:
+            self.server.bind()
+            self.server.serve_forever()
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+    
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            self._child()
+        self.children[pid] = time.monotonic()
+    
+    def _stop(self, signum, frame):
+        self.running = False
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    
+    def serve_forever(self):
+        self.running = True
+        self.server.server_close()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        while self.running or self.children:
+            while self.running and len(self.children) < self.processes:
+                self._spawn()
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                self.children.clear()
+                continue
+            started = self.children.pop(pid, None)
+            if self.running and started is not None and time.monotonic() - started < self.RESTART_DELAY:
+                time.sleep(self.RESTART_DELAY)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('usage: {} ZONEFILE ORIGIN [PORT] [PROCESSES]'.format(sys.argv[0]), file=sys.stderr)
+        sys.exit(2)
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 53
+    processes = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    server = NameServer([Zone.load(sys.argv[1], sys.argv[2])], port=port, reuseport=processes > 1)
+    if processes > 1:
+        Workers(server, processes).serve_forever()
+    else:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,277 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2012, Maximilian Köhl <linuxmaxi@googlemail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import collections
+import itertools
+import random
+import struct
+import time
+
+from dns import DNS, DNSClass, DNSQuery, DNSResponse, DNSType, pack_tcp
+
+def nameservers(path='/etc/resolv.conf'):
+    servers = []
+    try:
+        with open(path) as resolv:
+            for line in resolv:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    servers.append((fields[1].split('%')[0], 53))
+    except OSError:
+        pass
+    return servers or [('127.0.0.1', 53)]
+
+def normalize(qname):
+    return qname.rstrip('.').lower()
+
+class Cache():
+    RECORD_SIZE = 128
+    
+    def __init__(self, budget=16 << 20, max_ttl=86400, negative_ttl=10800, stale=3600, stale_ttl=30):
+        self.budget = budget
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.stale = stale
+        self.stale_ttl = stale_ttl
+        self.entries = collections.OrderedDict()
+        self.size = 0
+    
+    def _size(self, records):
+        size = self.RECORD_SIZE
+        for rname, rtype, rclass, rttl, rdata in records:
+            size += self.RECORD_SIZE + len(rname) + len(rdata)
+        return size
+    
+    def _remove(self, key):
+        self.size -= self.entries.pop(key)[-1]
+    
+    def put(self, key, response, now=None):
+        rcode = response.headers.get('rcode', DNS.RCODE_NO)
+        if rcode == DNS.RCODE_NO and response.answers:
+            ttl = min(min(record[3] for record in response.answers), self.max_ttl)
+        elif rcode in (DNS.RCODE_NO, DNS.RCODE_NAME):
+            soa = [record for record in response.authorities if record[1] == DNSType.SOA and isinstance(record[4], tuple)]
+            if not soa:
+                return
+            ttl = min(soa[0][3], soa[0][4][-1], self.negative_ttl)
+        else:
+            return
+        if ttl <= 0:
+            return
+        if key in self.entries:
+            self._remove(key)
+        now = time.monotonic() if now is None else now
+        size = self._size(response.answers) + self._size(response.authorities)
+        self.entries[key] = (now, now + ttl, dict(response.headers), tuple(response.answers), tuple(response.authorities), size)
+        self.size += size
+        while self.size > self.budget:
+            self._remove(next(iter(self.entries)))
+    
+    def get(self, key, qname, now=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None, False
+        stored, expires, headers, answers, authorities, size = entry
+        now = time.monotonic() if now is None else now
+        if now >= expires + self.stale:
+            self._remove(key)
+            return None, False
+        self.entries.move_to_end(key)
+        response = DNSResponse(0, dict(headers))
+        response.add_question(qname, key[1], key[2])
+        if now < expires:
+            elapsed = int(now - stored)
+            response.answers = [(rname, rtype, rclass, max(rttl - elapsed, 0), rdata)
+                                for rname, rtype, rclass, rttl, rdata in answers]
+            response.authorities = [(rname, rtype, rclass, max(rttl - elapsed, 0), rdata)
+                                    for rname, rtype, rclass, rttl, rdata in authorities]
+            return response, False
+        response.answers = [(rname, rtype, rclass, self.stale_ttl, rdata)
+                            for rname, rtype, rclass, rttl, rdata in answers]
+        response.authorities = [(rname, rtype, rclass, self.stale_ttl, rdata)
+                                for rname, rtype, rclass, rttl, rdata in authorities]
+        return response, True
+    
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+class Resolver():
+    class _Protocol(asyncio.DatagramProtocol):
+        def __init__(self, resolver):
+            self.resolver = resolver
+            self.transport = None
+        
+        def connection_made(self, transport):
+            self.transport = transport
+        
+        def datagram_received(self, data, address):
+            self.resolver._received(self, data, address)
+        
+        def error_received(self, exc):
+            pass
+        
+        def connection_lost(self, exc):
+            self.resolver._lost(self)
+    
+    def __init__(self, servers=None, sockets=4, timeout=2, retries=3, limit=512, cache=None):
+        self.servers = [tuple(server) for server in servers or nameservers()]
+        self.sockets = sockets
+        self.timeout = timeout
+        self.retries = retries
+        self.limit = asyncio.Semaphore(limit)
+        self.cache = cache
+        self.protocols = []
+        self.pools = {}
+        self.opening = None
+        self.pending = {}
+        self.inflight = {}
+        self.random = random.SystemRandom()
+    
+    async def _open(self):
+        loop = asyncio.get_running_loop()
+        for server in self.servers:
+            pool = []
+            for number in range(self.sockets):
+                transport, protocol = await loop.create_datagram_endpoint(lambda: self._Protocol(self),
+                                                                          remote_addr=server)
+                self.protocols.append(protocol)
+                pool.append(protocol)
+            self.pools[server] = itertools.cycle(pool)
+    
+    def _lost(self, protocol):
+        for key, future in list(self.pending.items()):
+            if key[0] is protocol and not future.done():
+                future.set_exception(ConnectionError('socket closed'))
+    
+    def _received(self, protocol, data, address):
+        try:
+            number = DNS.HEADER.unpack_from(data)[0]
+        except struct.error:
+            return
+        future = self.pending.get((protocol, number))
+        if future is None or future.done():
+            return
+        try:
+            response = DNS.parse(data)
+        except ValueError:
+            return
+        if response.mode != DNS.MODE_RESPONSE or len(response.questions) != 1:
+            return
+        qname, qtype, qclass = response.questions[0]
+        if (normalize(qname), qtype, qclass) != future.question:
+            return
+        future.set_result(response)
+    
+    async def _tcp(self, query, server):
+        reader, writer = await asyncio.open_connection(*server[:2])
+        try:
+            writer.write(pack_tcp(query))
+            await writer.drain()
+            length, = DNS.LENGTH.unpack(await reader.readexactly(DNS.LENGTH.size))
+            response = DNS.parse(await reader.readexactly(length))
+        finally:
+            writer.close()
+        if response.number != query.number:
+            raise ConnectionError('mismatched TCP response')
+        return response
+    
+    async def _resolve(self, qname, qtype, qclass):
+        if self.opening is None:
+            self.opening = asyncio.ensure_future(self._open())
+        await asyncio.shield(self.opening)
+        loop = asyncio.get_running_loop()
+        question = (normalize(qname), qtype, qclass)
+        query = DNSQuery(0, {'rd': DNS.RD_RECURSION})
+        query.add_question(qname, qtype, qclass)
+        error = None
+        async with self.limit:
+            for attempt in range(self.retries):
+                server = self.servers[attempt % len(self.servers)]
+                protocol = next(self.pools[server])
+                number = self.random.randrange(65536)
+                while (protocol, number) in self.pending:
+                    number = self.random.randrange(65536)
+                query.number = number
+                data = bytes(query)
+                future = loop.create_future()
+                future.question = question
+                self.pending[(protocol, number)] = future
+                try:
+                    protocol.transport.sendto(data)
+                    response = await asyncio.wait_for(future, self.timeout)
+                    if response.headers['tc']:
+                        response = await asyncio.wait_for(self._tcp(query, server), self.timeout)
+                    if self.cache is not None:
+                        self.cache.put(question, response)
+                    return response
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError, ValueError) as exc:
+                    error = exc
+                finally:
+                    del self.pending[(protocol, number)]
+        raise TimeoutError('no response for {} from {}'.format(qname, self.servers)) from error
+    
+    def _done(self, key, task):
+        self.inflight.pop(key, None)
+        if not task.cancelled():
+            task.exception()
+    
+    def _lookup(self, key, qname, qtype, qclass):
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.ensure_future(self._resolve(qname, qtype, qclass))
+            task.add_done_callback(lambda task: self._done(key, task))
+        return task
+    
+    async def query(self, qname, qtype=DNSType.A, qclass=DNSClass.IN):
+        key = (normalize(qname), qtype, qclass)
+        if self.cache is not None:
+            response, stale = self.cache.get(key, qname)
+            if response is not None:
+                if stale:
+                    self._lookup(key, qname, qtype, qclass)
+                return response
+        return await asyncio.shield(self._lookup(key, qname, qtype, qclass))
+    
+    def close(self):
+        for task in self.inflight.values():
+            task.cancel()
+        for protocol in self.protocols:
+            protocol.transport.close()
+        self.protocols = []
+        self.pools = {}
+        self.opening = None
+
+if __name__ == '__main__':
+    import sys
+    
+    async def main(names):
+        resolver = Resolver(cache=Cache())
+        try:
+            results = await asyncio.gather(*[resolver.query(name) for name in names], return_exceptions=True)
+        finally:
+            resolver.close()
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                print('{}: {}'.format(name, result))
+            else:
+                for rname, rtype, rclass, rttl, rdata in result.answers:
+                    print('{} {} {} {}'.format(rname, rttl, rtype, rdata))
+    
+    asyncio.run(main(sys.argv[1:] or ['example.com']))
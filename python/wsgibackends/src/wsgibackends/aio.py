@@ -0,0 +1,373 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2012, Maximilian Köhl <linuxmaxi@googlemail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import http
+import os
+import socket
+import tempfile
+import traceback
+
+from wsgibackends.environ import EnvironMixIn
+from wsgibackends.fcgi import FCGIServer
+
+FCGI = FCGIServer._Handler
+
+class _Protocol(asyncio.Protocol):
+    def __init__(self, server):
+        self.server = server
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.closed = self.loop.create_future()
+    
+    def connection_made(self, transport):
+        self.transport = transport
+    
+    def connection_lost(self, exc):
+        self.writable.set()
+        if not self.closed.done():
+            self.closed.set_result(None)
+    
+    def pause_writing(self):
+        self.writable.clear()
+    
+    def resume_writing(self):
+        self.writable.set()
+    
+    def dispatch(self, environ, stdin, send, end, cancelled=None):
+        stdin.seek(0)
+        environ = self.server.make_environ(environ, stdin)
+        if self.server.asgi:
+            self.loop.create_task(self._run_asgi(environ, send, end))
+        else:
+            self.loop.run_in_executor(self.server.executor, self._run_wsgi, environ, send, end, cancelled)
+    
+    def _run_wsgi(self, environ, send, end, cancelled=None):
+        headers, sent = [], []
+        
+        def start_response(status, response_headers, exc_info=None):
+            if exc_info is not None:
+                try:
+                    if sent:
+                        raise exc_info[1].with_traceback(exc_info[2])
+                finally:
+                    exc_info = None
+            lines = ['{}: {}'.format(name, value) for name, value in response_headers]
+            lines.append('Status: {}'.format(status))
+            headers[:] = [('\r\n'.join(lines) + '\r\n\r\n').encode('latin1')]
+            return write_body
+        
+        def write(chunk):
+            if not self.writable.is_set():
+                asyncio.run_coroutine_threadsafe(self.writable.wait(), self.loop).result()
+            self.loop.call_soon_threadsafe(send, chunk)
+        
+        def write_head():
+            if headers:
+                sent[:] = [True]
+                write(headers.pop())
+        
+        def write_body(chunk):
+            if chunk:
+                write_head()
+                write(chunk)
+        
+        try:
+            result = self.server.application(environ, start_response)
+            try:
+                for chunk in result:
+                    if self.transport.is_closing() or (cancelled is not None and cancelled()):
+                        break
+                    write_body(chunk)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            environ['wsgi.errors'].flush()
+            write_head()
+            self.loop.call_soon_threadsafe(end)
+    
+    @staticmethod
+    def _scope(environ):
+        headers = []
+        for name, value in environ.items():
+            if name.startswith('HTTP_'):
+                headers.append((name[5:].replace('_', '-').lower().encode('latin1'), value.encode('latin1')))
+            elif name in ('CONTENT_TYPE', 'CONTENT_LENGTH') and value:
+                headers.append((name.replace('_', '-').lower().encode('latin1'), value.encode('latin1')))
+        server_port = environ.get('SERVER_PORT')
+        remote_port = environ.get('REMOTE_PORT')
+        return {'type': 'http',
+                'asgi': {'version': '3.0', 'spec_version': '2.3'},
+                'http_version': environ.get('SERVER_PROTOCOL', 'HTTP/1.1').partition('/')[2] or '1.1',
+                'method': environ.get('REQUEST_METHOD', 'GET'),
+                'scheme': environ['wsgi.url_scheme'],
+                'path': environ.get('PATH_INFO', '/') or '/',
+                'raw_path': environ.get('REQUEST_URI', '').partition('?')[0].encode('latin1') or None,
+                'query_string': environ.get('QUERY_STRING', '').encode('latin1'),
+                'root_path': environ.get('SCRIPT_NAME', ''),
+                'headers': headers,
+                'server': (environ.get('SERVER_NAME'), int(server_port)) if server_port else None,
+                'client': (environ.get('REMOTE_ADDR'), int(remote_port)) if remote_port else None,
+                'environ': environ}
+    
+    async def _run_asgi(self, environ, send, end):
+        body = [environ['wsgi.input'].read()]
+        
+        async def receive():
+            if body:
+                return {'type': 'http.request', 'body': body.pop(), 'more_body': False}
+            await self.closed
+            return {'type': 'http.disconnect'}
+        
+        async def asgi_send(message):
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                lines = ['{}: {}'.format(name.decode('latin1'), value.decode('latin1')) for name, value in message.get('headers', ())]
+                lines.append('Status: {} {}'.format(status, http.HTTPStatus(status).phrase))
+                send(('\r\n'.join(lines) + '\r\n\r\n').encode('latin1'))
+            elif message['type'] == 'http.response.body':
+                if message.get('body'):
+                    await self.writable.wait()
+                    send(message['body'])
+        
+        try:
+            await self.server.application(self._scope(environ), receive, asgi_send)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            environ['wsgi.errors'].flush()
+            end()
+
+class _AsyncServer(EnvironMixIn):
+    def __init__(self, host, port, application, executor=None, asgi=False, reuseaddr=False, mode=None, fd=None, spool_size=1 << 20, max_header_size=65536):
+        self.host = host
+        self.port = port
+        self.mode = mode
+        self.fd = fd
+        self.application = application
+        self.executor = executor
+        self.asgi = asgi
+        self.multithread = not asgi
+        self.reuseaddr = reuseaddr
+        self.spool_size = spool_size
+        self.max_header_size = max_header_size
+        self.server = None
+    
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        factory = lambda: self._Protocol(self)
+        if self.fd is not None:
+            listener = socket.socket(fileno=self.fd)
+            if listener.family == socket.AF_UNIX:
+                self.server = await loop.create_unix_server(factory, sock=listener)
+            else:
+                self.server = await loop.create_server(factory, sock=listener)
+        elif self.port is None:
+            self.server = await loop.create_unix_server(factory, self.host)
+            if self.mode is not None:
+                os.chmod(self.host, self.mode)
+        else:
+            self.server = await loop.create_server(factory, self.host, self.port, reuse_address=self.reuseaddr)
+        return self.server
+    
+    def serve_forever(self):
+        async def serve():
+            async with await self.start() as server:
+                await server.serve_forever()
+        asyncio.run(serve())
+
+class AsyncFCGIServer(_AsyncServer):
+    class _Protocol(_Protocol):
+        class _Request():
+            def __init__(self, protocol, request_id, flags):
+                self.protocol = protocol
+                self.request_id = request_id
+                self.flags = flags
+                self.environ = {}
+                self.params = bytearray()
+                self.stdin = tempfile.SpooledTemporaryFile(max_size=protocol.server.spool_size)
+                self.running = False
+                self.cancelled = False
+            
+            def handle_record(self, type, content):
+                if type == FCGI.ABORT_REQUEST:
+                    self.cancelled = True
+                    if not self.running:
+                        self.end()
+                    return
+                if self.running:
+                    return
+                if type == FCGI.PARAMS:
+                    if content:
+                        self.params += content
+                    else:
+                        self.environ.update(FCGI._decode_pairs(self.params))
+                        self.params.clear()
+                elif type == FCGI.STDIN:
+                    if content:
+                        self.stdin.write(content)
+                    else:
+                        self.running = True
+                        self.protocol.dispatch(self.environ, self.stdin, self.send, self.end, lambda: self.cancelled)
+            
+            def send(self, content):
+                if self.cancelled:
+                    return
+                self.protocol.write_record(self.request_id, FCGI.STDOUT, content)
+            
+            def end(self):
+                self.protocol.write_record(self.request_id, FCGI.STDOUT, b'')
+                self.protocol.write_record(self.request_id, FCGI.END_REQUEST, FCGI.CONTENT_END_REQUEST.pack(0, 0, 0, 0, FCGI.REQUEST_COMPLETE, b'\x00\x00\x00'))
+                self.protocol.requests.pop(self.request_id, None)
+                self.stdin.close()
+                if not self.flags & FCGI.KEEP_CONN:
+                    self.protocol.transport.close()
+        
+        def __init__(self, server):
+            super().__init__(server)
+            self.buffer = bytearray()
+            self.requests = {}
+        
+        def connection_lost(self, exc):
+            super().connection_lost(exc)
+            for request in self.requests.values():
+                if not request.running:
+                    request.stdin.close()
+        
+        def write_record(self, request_id, type, content):
+            if self.transport.is_closing():
+                return
+            content = memoryview(content).cast('B')
+            buffers = []
+            for position in range(0, max(len(content), 1), FCGI.RECORD_CONTENT):
+                chunk = content[position:position + FCGI.RECORD_CONTENT]
+                padding = -len(chunk) & 7
+                buffers.append(FCGI.RECORD.pack(FCGI.VERSION, type, request_id >> 8, request_id & 255, len(chunk) >> 8, len(chunk) & 255, padding, 0))
+                buffers.append(chunk)
+                buffers.append(FCGI.PADDING[:padding])
+            self.transport.writelines(buffers)
+        
+        def _management_record(self, type, content):
+            if type == FCGI.GET_VALUES:
+                values = {'FCGI_MPXS_CONNS': '1'}
+                pairs = [(name.encode('latin1'), values[name].encode('latin1')) for name in FCGI._decode_pairs(content) if name in values]
+                self.write_record(FCGI.NULL_REQUEST_ID, FCGI.GET_VALUES_RESULT, FCGI._encode_pairs(pairs))
+            else:
+                self.write_record(FCGI.NULL_REQUEST_ID, FCGI.UNKNOWN_TYPE, FCGI.CONTENT_UNKNOWN_TYPE.pack(type, b'\x00' * 7))
+        
+        def _handle_record(self, record, content):
+            request_id = (record.request_id_b1 << 8) + record.request_id_b0
+            if request_id == FCGI.NULL_REQUEST_ID:
+                self._management_record(record.type, content)
+            elif record.type == FCGI.BEGIN_REQUEST:
+                begin_request = FCGI._ContentBeginRequest(*FCGI.CONTENT_BEGIN_REQUEST.unpack(content))
+                self.requests[request_id] = self._Request(self, request_id, begin_request.flags)
+            elif request_id in self.requests:
+                self.requests[request_id].handle_record(record.type, content)
+        
+        def data_received(self, data):
+            buffer = self.buffer
+            buffer += data
+            position = 0
+            while len(buffer) - position >= FCGI.RECORD.size:
+                record = FCGI._Record(*FCGI.RECORD.unpack_from(buffer, position))
+                content_length = (record.content_length_b1 << 8) + record.content_length_b0
+                start = position + FCGI.RECORD.size
+                end = start + content_length + record.padding_length
+                if end > len(buffer):
+                    break
+                self._handle_record(record, bytes(buffer[start:start + content_length]))
+                position = end
+            del buffer[:position]
+
+class AsyncSCGIServer(_AsyncServer):
+    class _Protocol(_Protocol):
+        def __init__(self, server):
+            super().__init__(server)
+            self.buffer = bytearray()
+            self.environ = None
+            self.stdin = None
+            self.remaining = 0
+            self.running = False
+        
+        def connection_lost(self, exc):
+            super().connection_lost(exc)
+            if self.stdin is not None and not self.running:
+                self.stdin.close()
+        
+        def send(self, content):
+            if not self.transport.is_closing():
+                self.transport.write(content)
+        
+        def end(self):
+            self.stdin.close()
+            self.transport.close()
+        
+        def _headers(self):
+            colon = self.buffer.find(b':')
+            if colon < 0:
+                if len(self.buffer) > 10:
+                    self.transport.close()
+                return False
+            digits = self.buffer[:colon]
+            if colon > 10 or not digits.isdigit() or int(digits) > self.server.max_header_size:
+                self.transport.close()
+                return False
+            length = int(digits)
+            if len(self.buffer) < colon + length + 2:
+                return False
+            if self.buffer[colon + 1 + length] != ord(','):
+                self.transport.close()
+                return False
+            fields = bytes(self.buffer[colon + 1:colon + 1 + length]).split(b'\x00')
+            del self.buffer[:colon + length + 2]
+            environ = {fields[i].decode('latin1'): fields[i + 1].decode('latin1') for i in range(0, len(fields) - 1, 2)}
+            length = environ.get('CONTENT_LENGTH') or '0'
+            if not length.isascii() or not length.isdigit():
+                self.transport.write(b'Status: 400 Bad Request\r\nContent-Type: text/plain\r\n\r\n400 Bad Request')
+                self.transport.close()
+                return False
+            self.environ = environ
+            self.remaining = int(length)
+            self.stdin = tempfile.SpooledTemporaryFile(max_size=self.server.spool_size)
+            return True
+        
+        def data_received(self, data):
+            if self.running:
+                return
+            if self.environ is None:
+                self.buffer += data
+                if not self._headers():
+                    return
+                data, self.buffer = self.buffer, None
+            data = data[:self.remaining]
+            self.stdin.write(data)
+            self.remaining -= len(data)
+            if not self.remaining:
+                self.running = True
+                self.dispatch(self.environ, self.stdin, self.send, self.end)
+
+if __name__ == '__main__':
+    from wsgiref.simple_server import demo_app
+    
+    AsyncFCGIServer('0.0.0.0', 8888, demo_app, reuseaddr=True).serve_forever()
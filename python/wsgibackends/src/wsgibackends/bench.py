@@ -0,0 +1,165 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2012, Maximilian Köhl <linuxmaxi@googlemail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import itertools
+import os
+import signal
+import threading
+import time
+
+from wsgibackends.client import FCGIClient, SCGIClient, split_response
+from wsgibackends.fcgi import FCGIServer
+from wsgibackends.scgi import SCGIServer
+
+SCENARIOS = ('hello', 'upload', 'stream', 'slow')
+
+CHUNK = b'x' * 65536
+
+def application(environ, start_response):
+    path = environ.get('PATH_INFO', '')
+    if path == '/upload':
+        stream, length = environ['wsgi.input'], 0
+        while True:
+            data = stream.read(65536)
+            if not data:
+                break
+            length += len(data)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [str(length).encode('ascii')]
+    elif path == '/stream':
+        size = int(environ.get('QUERY_STRING') or 0)
+        start_response('200 OK', [('Content-Type', 'application/octet-stream'), ('Content-Length', str(size))])
+        return (CHUNK[:min(len(CHUNK), size - position)] for position in range(0, size, len(CHUNK)))
+    elif path == '/slow':
+        time.sleep(float(environ.get('QUERY_STRING') or 0))
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'Hello, World!']
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def run(send, concurrency, requests):
+    counter = itertools.count()
+    latencies, errors = [], []
+    
+    def worker():
+        while next(counter) < requests:
+            start = time.perf_counter()
+            try:
+                ok = send()
+            except (OSError, ValueError):
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(1)
+    
+    threads = [threading.Thread(target=worker) for number in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return len(latencies), len(errors), elapsed, latencies
+
+def scenario(name, args):
+    body, query = b'', ''
+    if name == 'upload':
+        body = b'u' * args.body_size
+    elif name == 'stream':
+        query = str(args.response_size)
+    elif name == 'slow':
+        query = str(args.delay)
+    environ = {'REQUEST_METHOD': 'POST' if body else 'GET', 'PATH_INFO': '/' + name, 'QUERY_STRING': query,
+               'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1'}
+    return environ, body
+
+def fcgi_sender(clients, environ, body):
+    clients = itertools.cycle(clients)
+    
+    def send():
+        response = next(clients).request(environ, body)
+        return response.protocol_status == FCGI_REQUEST_COMPLETE and split_response(response.stdout)[0] == '200 OK'
+    return send
+
+def scgi_sender(client, environ, body):
+    def send():
+        return split_response(client.request(environ, body))[0] == '200 OK'
+    return send
+
+FCGI_REQUEST_COMPLETE = FCGIServer._Handler.REQUEST_COMPLETE
+
+def serve(server):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            server.serve_forever()
+        finally:
+            os._exit(0)
+    server.socket.close()
+    return pid
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark the wsgibackends servers')
+    parser.add_argument('--protocol', choices=('fcgi', 'scgi'), action='append')
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--connections', type=int, default=4, help='multiplexed fcgi connections')
+    parser.add_argument('--no-keep-conn', dest='keep_conn', action='store_false')
+    parser.add_argument('--body-size', type=int, default=1 << 20)
+    parser.add_argument('--response-size', type=int, default=8 << 20)
+    parser.add_argument('--delay', type=float, default=0.05)
+    args = parser.parse_args(argv)
+    
+    print('{:<6} {:<8} {:>8} {:>7} {:>10} {:>9} {:>9} {:>9}'.format('proto', 'scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms', 'p999 ms'))
+    for protocol in args.protocol or ('fcgi', 'scgi'):
+        if protocol == 'fcgi':
+            server = FCGIServer('127.0.0.1', 0, application, True, workers=args.workers, queue_size=args.concurrency * 2, max_body_size=None)
+        else:
+            server = SCGIServer('127.0.0.1', 0, application, True, workers=args.workers, queue_size=args.concurrency * 2)
+        address = server.server_address
+        pid = serve(server)
+        try:
+            for name in args.scenario or SCENARIOS:
+                environ, body = scenario(name, args)
+                if protocol == 'fcgi':
+                    clients = [FCGIClient(address, args.keep_conn) for number in range(args.connections)]
+                    send = fcgi_sender(clients, environ, body)
+                else:
+                    send = scgi_sender(SCGIClient(address), environ, body)
+                completed, errors, elapsed, latencies = run(send, args.concurrency, args.requests)
+                if protocol == 'fcgi':
+                    for client in clients:
+                        client.close()
+                if latencies:
+                    p50, p99, p999 = (percentile(latencies, fraction) * 1000 for fraction in (0.5, 0.99, 0.999))
+                else:
+                    p50 = p99 = p999 = float('nan')
+                print('{:<6} {:<8} {:>8} {:>7} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(protocol, name, completed, errors, completed / elapsed, p50, p99, p999))
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2012, Maximilian Köhl <linuxmaxi@googlemail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import socket
+import struct
+import threading
+
+from wsgibackends.fcgi import FCGIServer
+
+FCGI = FCGIServer._Handler
+
+Response = collections.namedtuple('Response', ['stdout', 'stderr', 'protocol_status', 'app_status'])
+
+def connect(address):
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+        return sock
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+def split_response(data):
+    head, _, body = data.partition(b'\r\n\r\n')
+    status, headers = None, []
+    for line in head.decode('latin1').split('\r\n'):
+        name, _, value = line.partition(':')
+        if name.lower() == 'status':
+            status = value.strip()
+        elif name:
+            headers.append((name, value.strip()))
+    return status, headers, body
+
+class FCGIClient():
+    class _Request():
+        def __init__(self):
+            self.stdout = []
+            self.stderr = []
+            self.protocol_status = None
+            self.app_status = None
+            self.done = threading.Event()
+    
+    class _Connection():
+        def __init__(self, client):
+            self.client = client
+            self.sock = connect(client.address)
+            self.lock = threading.Lock()
+            self.requests = {}
+            self.values = {}
+            self.values_done = threading.Event()
+            self.buffer = bytearray()
+            self.closed = False
+        
+        def send(self, data):
+            with self.lock:
+                self.sock.sendall(data)
+        
+        def _handle_record(self, record, content):
+            request_id = (record.request_id_b1 << 8) + record.request_id_b0
+            if record.type == FCGI.GET_VALUES_RESULT:
+                self.values = FCGI._decode_pairs(content)
+                self.values_done.set()
+                return
+            request = self.requests.get(request_id)
+            if request is None:
+                return
+            if record.type == FCGI.STDOUT:
+                request.stdout.append(content)
+            elif record.type == FCGI.STDERR:
+                request.stderr.append(content)
+            elif record.type == FCGI.END_REQUEST:
+                app_status, request.protocol_status = struct.unpack_from('! L B', content)
+                request.app_status = app_status
+                del self.requests[request_id]
+                request.done.set()
+        
+        def receive(self):
+            data = self.sock.recv(FCGI.RECV_SIZE)
+            if not data:
+                self.close()
+                return False
+            buffer = self.buffer
+            buffer += data
+            position = 0
+            while len(buffer) - position >= FCGI.RECORD.size:
+                record = FCGI._Record(*FCGI.RECORD.unpack_from(buffer, position))
+                content_length = (record.content_length_b1 << 8) + record.content_length_b0
+                start = position + FCGI.RECORD.size
+                end = start + content_length + record.padding_length
+                if end > len(buffer):
+                    break
+                self._handle_record(record, bytes(buffer[start:start + content_length]))
+                position = end
+            del buffer[:position]
+            return True
+        
+        def run(self):
+            try:
+                while self.receive():
+                    pass
+            except OSError:
+                self.close()
+        
+        def close(self):
+            self.closed = True
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.values_done.set()
+            for request in list(self.requests.values()):
+                request.done.set()
+    
+    def __init__(self, address, keep_conn=True):
+        self.address = address
+        self.keep_conn = keep_conn
+        self.lock = threading.Lock()
+        self.connection = None
+        self.request_ids = collections.deque(range(1, 65536))
+    
+    @staticmethod
+    def _record(type, request_id, content=b''):
+        records = []
+        content = memoryview(content)
+        for position in range(0, max(len(content), 1), FCGI.RECORD_CONTENT):
+            chunk = content[position:position + FCGI.RECORD_CONTENT]
+            padding = -len(chunk) & 7
+            records.append(FCGI.RECORD.pack(FCGI.VERSION, type, request_id >> 8, request_id & 255, len(chunk) >> 8, len(chunk) & 255, padding, 0))
+            records.append(chunk)
+            records.append(FCGI.PADDING[:padding])
+        return records
+    
+    def _connection(self):
+        with self.lock:
+            if self.connection is None or self.connection.closed:
+                self.connection = self._Connection(self)
+                threading.Thread(target=self.connection.run, daemon=True).start()
+            return self.connection
+    
+    def get_values(self, names=('FCGI_MAX_CONNS', 'FCGI_MAX_REQS', 'FCGI_MPXS_CONNS'), timeout=None):
+        connection = self._connection()
+        connection.values_done.clear()
+        content = FCGI._encode_pairs([(name.encode('latin1'), b'') for name in names])
+        connection.send(b''.join(self._record(FCGI.GET_VALUES, FCGI.NULL_REQUEST_ID, content)))
+        connection.values_done.wait(timeout)
+        return connection.values
+    
+    def request(self, params, body=b'', timeout=None):
+        with self.lock:
+            request_id = self.request_ids.popleft()
+        try:
+            request = self._Request()
+            flags = FCGI.KEEP_CONN if self.keep_conn else 0
+            pairs = FCGI._encode_pairs([(name.encode('latin1'), value.encode('latin1')) for name, value in params.items()])
+            records = self._record(FCGI.BEGIN_REQUEST, request_id, FCGI.CONTENT_BEGIN_REQUEST.pack(0, FCGI.RESPONDER, flags, b'\x00' * 5))
+            records.extend(self._record(FCGI.PARAMS, request_id, pairs))
+            records.extend(self._record(FCGI.PARAMS, request_id))
+            if body:
+                records.extend(self._record(FCGI.STDIN, request_id, body))
+            records.extend(self._record(FCGI.STDIN, request_id))
+            if self.keep_conn:
+                connection = self._connection()
+                connection.requests[request_id] = request
+                connection.send(b''.join(records))
+                request.done.wait(timeout)
+            else:
+                connection = self._Connection(self)
+                connection.requests[request_id] = request
+                try:
+                    connection.send(b''.join(records))
+                    while not request.done.is_set() and connection.receive():
+                        pass
+                finally:
+                    connection.close()
+            if request.protocol_status is None:
+                connection.requests.pop(request_id, None)
+                raise ConnectionError('request {} did not complete'.format(request_id))
+            return Response(b''.join(request.stdout), b''.join(request.stderr), request.protocol_status, request.app_status)
+        finally:
+            with self.lock:
+                self.request_ids.append(request_id)
+    
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+class SCGIClient():
+    def __init__(self, address):
+        self.address = address
+    
+    def request(self, environ, body=b''):
+        fields = {'CONTENT_LENGTH': str(len(body)), 'SCGI': '1'}
+        fields.update((name, value) for name, value in environ.items() if name not in fields)
+        headers = b''.join(name.encode('latin1') + b'\x00' + value.encode('latin1') + b'\x00' for name, value in fields.items())
+        sock = connect(self.address)
+        try:
+            sock.sendall(str(len(headers)).encode('ascii') + b':' + headers + b',')
+            if body:
+                sock.sendall(body)
+            chunks = []
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+            return b''.join(chunks)
+        finally:
+            sock.close()
@@ -0,0 +1,88 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2012, Maximilian Köhl <linuxmaxi@googlemail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import io
+import logging
+import threading
+import wsgiref.util
+
+class ErrorStream(io.TextIOBase):
+    def __init__(self, logger=None):
+        self.logger = logging.getLogger('wsgibackends.errors') if logger is None else logger
+        self.local = threading.local()
+    
+    def writable(self):
+        return True
+    
+    def write(self, text):
+        lines = (getattr(self.local, 'buffer', '') + text).split('\n')
+        self.local.buffer = lines.pop()
+        for line in lines:
+            self.logger.error(line)
+        return len(text)
+    
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+    
+    def flush(self):
+        buffer = getattr(self.local, 'buffer', '')
+        if buffer:
+            self.local.buffer = ''
+            self.logger.error(buffer)
+    
+    def close(self):
+        pass
+
+ERRORS = ErrorStream()
+
+class EnvironMixIn():
+    errors = ERRORS
+    file_wrapper = wsgiref.util.FileWrapper
+    multithread = True
+    input_terminated = False
+    _multiprocess = False
+    _environ = None
+    _environ_https = None
+    
+    @property
+    def multiprocess(self):
+        return self._multiprocess
+    
+    @multiprocess.setter
+    def multiprocess(self, multiprocess):
+        self._multiprocess = multiprocess
+        self._environ = self._environ_https = None
+    
+    def base_environ(self, https=False):
+        if self._environ is None:
+            environ = {'wsgi.errors': self.errors,
+                       'wsgi.file_wrapper': self.file_wrapper,
+                       'wsgi.multiprocess': self.multiprocess,
+                       'wsgi.multithread': self.multithread,
+                       'wsgi.run_once': False,
+                       'wsgi.url_scheme': 'http',
+                       'wsgi.version': (1, 0)}
+            if self.input_terminated:
+                environ['wsgi.input_terminated'] = True
+            self._environ_https = dict(environ, **{'wsgi.url_scheme': 'https'})
+            self._environ = environ
+        return self._environ_https if https else self._environ
+    
+    def make_environ(self, params, input):
+        return {**params, **self.base_environ(params.get('HTTPS') in ('on', '1')), 'wsgi.input': input}
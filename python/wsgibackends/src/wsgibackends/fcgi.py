@@ -16,17 +16,25 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import collections
-import functools
 import io
-import os
+import selectors
+import socket
 import socketserver
-import select
 import struct
+import tempfile
 import threading
-import wsgiref.util
+import time
+import traceback
 
-class FCGIServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    class _Handler(socketserver.StreamRequestHandler):
+from wsgibackends.environ import EnvironMixIn
+from wsgibackends.listen import ListenMixIn
+from wsgibackends.metrics import Metrics
+from wsgibackends.pool import PoolMixIn, WorkerPool
+
+class FCGIServer(ListenMixIn, EnvironMixIn, PoolMixIn, socketserver.TCPServer):
+    input_terminated = True
+    
+    class _Handler(socketserver.BaseRequestHandler):
         VERSION = 1
     
         BEGIN_REQUEST = 1
@@ -55,7 +63,12 @@ class FCGIServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
         OVERLOADED = 2
         UNKNOWN_ROLE = 3
         
+        RECV_SIZE = 65536
+        RECORD_CONTENT = 0xFFF8
+        PADDING = bytes(7)
+        
         RECORD = struct.Struct('! B B B B B B B B')
+        LENGTH = struct.Struct('! L')
         
         CONTENT_BEGIN_REQUEST = struct.Struct('! B B B 5s')
         CONTENT_END_REQUEST = struct.Struct('! B B B B B 3s')
@@ -66,119 +79,532 @@ class FCGIServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
         _ContentBeginRequest = collections.namedtuple('ContentBeginRequest', ['role_b1', 'role_b0', 'flags', 'reserved'])
         
         class _Request():
-            class _Stdin():
-                def __init__(self):
-                    read, write = os.pipe()
-                    self.rfile = os.fdopen(read, 'rb', 0)
-                    self.wfile = os.fdopen(write, 'wb', 0)
-                    for name in ('fileno', 'read', 'readline', 'readlines', 'seek', 'tell', 'truncate', '__iter__'):
-                        setattr(self, name, functools.partial(self._redict, name))
-                
-                def _redict(self, name, *args, **kwargs):
-                    return getattr(self.rfile, name)(*args, **kwargs)
-                    
-                def write(self, content):
-                    self.wfile.write(content)
-                                            
+            class _Output():
+                COPY_SIZE = 4096
+                
+                def __init__(self, request, size):
+                    self.request = request
+                    self.size = size
+                    self.buffers = collections.deque()
+                    self.length = 0
+                    self.accumulator = None
+                
+                def _take(self, length):
+                    buffers = []
+                    self.length -= length
+                    while length:
+                        buffer = self.buffers[0]
+                        if len(buffer) <= length:
+                            buffers.append(self.buffers.popleft())
+                            length -= len(buffer)
+                        else:
+                            buffers.append(buffer[:length])
+                            self.buffers[0] = buffer[length:]
+                            length = 0
+                    return buffers
+                
+                def write(self, chunk):
+                    if not chunk:
+                        return
+                    if len(chunk) < self.COPY_SIZE:
+                        if not self.buffers or self.buffers[-1] is not self.accumulator:
+                            self.accumulator = bytearray()
+                            self.buffers.append(self.accumulator)
+                        self.accumulator += chunk
+                    else:
+                        self.buffers.append(memoryview(chunk).cast('B'))
+                    self.length += len(chunk)
+                    if self.length >= self.size:
+                        self._send(self.request.handler.RECORD_CONTENT)
+                        if self.length >= self.size:
+                            self.flush()
+                
+                def _send(self, minimum):
+                    handler = self.request.handler
+                    while self.length >= minimum:
+                        handler.send_records([(self.request.request_id, handler.STDOUT, self._take(handler.RECORD_CONTENT))])
+                
+                def flush(self, trailer=()):
+                    handler = self.request.handler
+                    self._send(handler.RECORD_CONTENT + 1)
+                    records = []
+                    if self.length:
+                        records.append((self.request.request_id, handler.STDOUT, self._take(self.length)))
+                    for type, content in trailer:
+                        records.append((self.request.request_id, type, [content]))
+                    if records:
+                        handler.send_records(records)
+                
+                def discard(self):
+                    self.buffers.clear()
+                    self.length = 0
+                    self.accumulator = None
+            
+            class _Errors(io.TextIOBase):
+                def __init__(self, request):
+                    self.request = request
+                    self.used = False
+                
+                def writable(self):
+                    return True
+                
+                def write(self, text):
+                    if text:
+                        self.used = True
+                        self.request.write_record(self.request.handler.STDERR, text.encode('utf-8', 'replace'))
+                    return len(text)
+                
+                def writelines(self, lines):
+                    self.write(''.join(lines))
+            
+            class _Input(io.RawIOBase):
+                def __init__(self, request, spool_size):
+                    self.request = request
+                    self.file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+                    self.condition = threading.Condition()
+                    self.read_position = 0
+                    self.write_position = 0
+                    self.eof = False
+                    self.error = None
+                
+                def readable(self):
+                    return True
+                
+                def feed(self, content):
+                    with self.condition:
+                        if self.closed:
+                            return
+                        if content:
+                            self.file.seek(self.write_position)
+                            self.file.write(content)
+                            self.write_position += len(content)
+                        else:
+                            self.eof = True
+                        self.condition.notify_all()
+                
+                def fail(self, error):
+                    with self.condition:
+                        self.error = error
+                        self.condition.notify_all()
+                
+                def wake(self):
+                    with self.condition:
+                        self.condition.notify_all()
+                
+                def readinto(self, buffer):
+                    with self.condition:
+                        while self.read_position == self.write_position and not self.eof and self.error is None and not self.request.cancelled:
+                            self.condition.wait()
+                        available = self.write_position - self.read_position
+                        if not available:
+                            if self.error is not None:
+                                raise ValueError(self.error)
+                            if not self.eof:
+                                raise OSError('request aborted')
+                            return 0
+                        self.file.seek(self.read_position)
+                        data = self.file.read(min(len(buffer), available))
+                        buffer[:len(data)] = data
+                        self.read_position += len(data)
+                        return len(data)
+                
+                def close(self):
+                    with self.condition:
+                        if not self.closed:
+                            self.file.close()
+                            super().close()
+            
             def __init__(self, handler, request_id, role, flags):
                 self.handler = handler
                 self.request_id = request_id
                 self.role = role
                 self.flags = flags
                 self.environ = {}
-                self.lock = threading.Lock()
-                self.stdin = self._Stdin()
-                self.mapping = {self.handler.PARAMS: self._record_params,
+                self.params = bytearray()
+                self.input = self._Input(self, self.handler.server.spool_size)
+                self.stdin_length = 0
+                self.output = self._Output(self, self.handler.server.output_size)
+                self.mapping = {self.handler.ABORT_REQUEST: self._record_abort,
+                                self.handler.PARAMS: self._record_params,
                                 self.handler.STDIN: self._record_stdin}
                 self.running = False
+                self.cancelled = False
+                self.errors = None
+                self.queued = None
+                self.status = None
+                self.app_time = None
+                self.handler.server.metrics.request_started()
+            
+            def cancel(self):
+                self.cancelled = True
+                self.input.wake()
+            
+            def _record_abort(self, content):
+                self.cancel()
+                if not self.running:
+                    self.end_request()
             
             def _record_params(self, content):
-                position = 0
-                while position < len(content):
-                    name_len = content[position]
-                    position += 1
-                    if name_len & 128:
-                        name_len = ((name_len & 127) << 24) + (content[position] << 16) + (content[position + 1] << 8) + content[position + 2]
-                        position += 3
-                    value_len = content[position]
-                    position += 1
-                    if value_len & 128:
-                        value_len = ((name_len & 127) << 24) + (content[position] << 16) + (content[position + 1] << 8) + content[position + 2]
-                        position += 3
-                    self.environ[content[position:position + name_len].decode('latin1')] = content[position + name_len:position + name_len + value_len].decode('latin1')
-                    position += name_len + value_len
+                if self.running:
+                    return
+                if content:
+                    self.params += content
+                    return
+                self.environ.update(self.handler._decode_pairs(self.params))
+                self.params.clear()
+                max_body_size = self.handler.server.max_body_size
+                content_length = self.environ.get('CONTENT_LENGTH', '')
+                if max_body_size is not None and content_length.isdigit() and int(content_length) > max_body_size:
+                    self._reject('413 Request Entity Too Large')
+                    return
+                self.running = True
+                self.queued = time.monotonic()
+                self.handler.server.pool.submit(self.run, expire=self.expire)
                 
             def _record_stdin(self, content):
-                self.stdin.write(content)
-                if not self.running:
-                    self.running = True
-                    threading.Thread(target=self.run).start()
+                if content:
+                    self.stdin_length += len(content)
+                    max_body_size = self.handler.server.max_body_size
+                    if max_body_size is not None and self.stdin_length > max_body_size:
+                        if self.running:
+                            self.input.fail('413 Request Entity Too Large')
+                        else:
+                            self._reject('413 Request Entity Too Large')
+                        return
+                self.input.feed(content)
+            
+            def _error(self, status):
+                self.status = status.split(' ', 1)[0]
+                self.output.write('Status: {}\r\nContent-Type: text/plain\r\n\r\n{}'.format(status, status).encode('latin1'))
+            
+            def _reject(self, status):
+                self._error(status)
+                self.end_request()
                         
             def handle_record(self, record, content):
                 if record.type in self.mapping:
                     self.mapping[record.type](content)
             
             def write_record(self, type, content):
-                length = len(content)
-                padding = ((length + 7) & (0xFFFF - 7)) - length
-                record = self.handler.RECORD.pack(self.handler.VERSION, type, self.request_id >> 8, self.request_id & 255, length >> 8, length & 255, padding, 0)
-                with self.lock:
-                    self.handler.wfile.write(record + content + padding * b'\x00')
+                self.handler.write_record(self.request_id, type, content)
+            
+            def end_request(self, protocol_status=0):
+                if self.cancelled:
+                    self.output.discard()
+                trailer = [(self.handler.STDOUT, b'')]
+                if self.errors is not None and self.errors.used:
+                    trailer.append((self.handler.STDERR, b''))
+                trailer.append((self.handler.END_REQUEST, self.handler.CONTENT_END_REQUEST.pack(0, 0, 0, 0, protocol_status, b'\x00\x00\x00')))
+                self.output.flush(trailer)
+                self.handler.remove_request(self.request_id, self.flags & self.handler.KEEP_CONN)
+                self.close()
+            
+            def close(self):
+                if not self.running:
+                    self.handler.server.pool.release()
+                self.input.close()
+                self.handler.server.metrics.request_finished(self.status, self.app_time)
+            
+            def expire(self):
+                self.end_request(self.handler.OVERLOADED)
             
             def run(self):
-                self.environ['wsgi.errors'] = io.StringIO()
-                self.environ['wsgi.file_wrapper'] = wsgiref.util.FileWrapper
-                self.environ['wsgi.input'] = self.stdin
-                self.environ['wsgi.multiprocess'] = False
-                self.environ['wsgi.multithread'] = True
-                self.environ['wsgi.run_once'] = False
-                self.environ['wsgi.version'] = (1, 0)
-                if self.environ.get('HTTPS', 'off') in ('on', '1'):
-                    self.environ['wsgi.url_scheme'] = 'https'
-                else:
-                    self.environ['wsgi.url_scheme'] = 'http'
-                                
+                server = self.handler.server
+                started = time.monotonic()
+                server.metrics.request_dequeued(started - self.queued)
+                if self.cancelled:
+                    self.app_time = 0
+                    self.end_request()
+                    return
+                self.environ = server.make_environ(self.environ, io.BufferedReader(self.input))
+                if server.stderr:
+                    self.errors = self.environ['wsgi.errors'] = self._Errors(self)
+                
+                def write(chunk):
+                    self.output.write(chunk)
+                    self.output.flush()
+                
                 def start_response(status, headers):
+                    self.status = status.split(' ', 1)[0]
                     headers = ['{}: {}'.format(name, value) for name, value in headers] 
                     headers.append('Status: {}'.format(status))
-                    self.write_record(self.handler.STDOUT, ('\r\n'.join(headers) + '\r\n\r\n').encode('latin1'))
-                 
-                for chunk in self.handler.server.application(self.environ, start_response):
-                    self.write_record(self.handler.STDOUT, chunk)
-                
-                self.write_record(self.handler.STDOUT, b'')
-                # Why does this not work?
-                self.write_record(self.handler.END_REQUEST, self.handler.CONTENT_END_REQUEST.pack(0, 0, 0, 0, 0, b'\x00\x00\x00'))
-                del self.handler.requests[self.request_id]
+                    self.output.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin1'))
+                    return write
                 
+                application = server.application
+                if server.metrics_path is not None and self.environ.get('SCRIPT_NAME', '') + self.environ.get('PATH_INFO', '') == server.metrics_path:
+                    application = server.metrics.application
+                try:
+                    result = application(self.environ, start_response)
+                    burst = isinstance(result, (list, tuple, server.file_wrapper))
+                    try:
+                        for chunk in result:
+                            if self.cancelled:
+                                break
+                            self.output.write(chunk)
+                            if not burst:
+                                self.output.flush()
+                    finally:
+                        if hasattr(result, 'close'):
+                            result.close()
+                except Exception:
+                    if self.input.error is not None and self.status is None:
+                        self._error(self.input.error)
+                    elif not self.cancelled:
+                        traceback.print_exc()
+                finally:
+                    self.environ['wsgi.errors'].flush()
+                    self.app_time = time.monotonic() - started
+                    self.end_request(self.handler.REQUEST_COMPLETE)
+        
+        @classmethod
+        def _decode_pairs(cls, content):
+            view = memoryview(content)
+            text = str(view, 'latin1')
+            pairs = {}
+            position, end = 0, len(view)
+            try:
+                while position < end:
+                    name_len = view[position]
+                    if name_len & 128:
+                        name_len = cls.LENGTH.unpack_from(view, position)[0] & 0x7FFFFFFF
+                        position += 4
+                    else:
+                        position += 1
+                    value_len = view[position]
+                    if value_len & 128:
+                        value_len = cls.LENGTH.unpack_from(view, position)[0] & 0x7FFFFFFF
+                        position += 4
+                    else:
+                        position += 1
+                    name_end = position + name_len
+                    value_end = name_end + value_len
+                    if value_end > end:
+                        raise ValueError('truncated name-value pair')
+                    pairs[text[position:name_end]] = text[name_end:value_end]
+                    position = value_end
+            except (IndexError, struct.error):
+                raise ValueError('truncated name-value pair')
+            finally:
+                view.release()
+            return pairs
+        
+        @classmethod
+        def _encode_pairs(cls, pairs):
+            content = []
+            for name, value in pairs:
+                for length in (len(name), len(value)):
+                    if length < 128:
+                        content.append(bytes([length]))
+                    else:
+                        content.append(cls.LENGTH.pack(length | 0x80000000))
+                content.append(name)
+                content.append(value)
+            return b''.join(content)
+        
+        def _sendmsg(self, buffers):
+            while buffers:
+                sent = self.request.sendmsg(buffers)
+                self.server.metrics.sent(sent)
+                while sent:
+                    if sent >= len(buffers[0]):
+                        sent -= len(buffers.pop(0))
+                    else:
+                        buffers[0] = memoryview(buffers[0])[sent:]
+                        sent = 0
+        
+        def send_records(self, records):
+            if self.broken:
+                return
+            buffers = []
+            for request_id, type, contents in records:
+                length = sum(map(len, contents))
+                padding = -length & 7
+                buffers.append(self.RECORD.pack(self.VERSION, type, request_id >> 8, request_id & 255, length >> 8, length & 255, padding, 0))
+                buffers.extend(content for content in contents if content)
+                if padding:
+                    buffers.append(self.PADDING[:padding])
+            with self.lock:
+                try:
+                    self._sendmsg(buffers)
+                except OSError:
+                    self._broken()
+        
+        def _broken(self):
+            self.broken = True
+            with self.requests_lock:
+                for request in self.requests.values():
+                    request.cancel()
+            self.close()
+        
+        def write_record(self, request_id, type, content):
+            content = memoryview(content).cast('B')
+            records = [(request_id, type, [content[position:position + self.RECORD_CONTENT]])
+                       for position in range(0, len(content), self.RECORD_CONTENT)]
+            self.send_records(records or [(request_id, type, [])])
+        
         def _begin_request(self, request_id, content):
             begin_request = self._ContentBeginRequest(*self.CONTENT_BEGIN_REQUEST.unpack(content))
-            self.requests[request_id] = self._Request(self, request_id, (begin_request.role_b1 << 8) + begin_request.role_b0, begin_request.flags)        
+            if not self.server.pool.acquire():
+                self.send_records([(request_id, self.END_REQUEST, [self.CONTENT_END_REQUEST.pack(0, 0, 0, 0, self.OVERLOADED, b'\x00\x00\x00')])])
+                if not begin_request.flags & self.KEEP_CONN:
+                    self.close()
+                return
+            with self.requests_lock:
+                self.requests[request_id] = self._Request(self, request_id, (begin_request.role_b1 << 8) + begin_request.role_b0, begin_request.flags)
+                self.idle_since = None
+                self.server.connection_busy(self)
+        
+        def remove_request(self, request_id, keep_conn):
+            with self.requests_lock:
+                self.requests.pop(request_id, None)
+                if not keep_conn or (self.server.draining and not self.requests):
+                    self.close()
+                elif not self.requests:
+                    self.idle_since = time.monotonic()
+                    self.server.connection_idle(self)
+        
+        def close(self):
+            try:
+                self.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        
+        def _get_values(self, content):
+            values = {'FCGI_MAX_CONNS': str(self.server.connection_pool.workers),
+                      'FCGI_MAX_REQS': str(self.server.pool.workers + self.server.pool.queue_size),
+                      'FCGI_MPXS_CONNS': '1'}
+            pairs = [(name.encode('latin1'), values[name].encode('latin1')) for name in self._decode_pairs(content) if name in values]
+            self.write_record(self.NULL_REQUEST_ID, self.GET_VALUES_RESULT, self._encode_pairs(pairs))
+        
+        def _management_record(self, record, content):
+            if record.type == self.GET_VALUES:
+                self._get_values(content)
+            else:
+                self.write_record(self.NULL_REQUEST_ID, self.UNKNOWN_TYPE, self.CONTENT_UNKNOWN_TYPE.pack(record.type, b'\x00' * 7))
+        
+        def _handle_record(self, record, content):
+            request_id = (record.request_id_b1 << 8) + record.request_id_b0
+            if request_id == self.NULL_REQUEST_ID:
+                self._management_record(record, content)
+            elif record.type == self.BEGIN_REQUEST:
+                self._begin_request(request_id, content)
+            else:
+                request = self.requests.get(request_id)
+                if request is not None:
+                    request.handle_record(record, content)
+        
+        def _handle_records(self, buffer):
+            position = 0
+            while len(buffer) - position >= self.RECORD.size:
+                record = self._Record(*self.RECORD.unpack_from(buffer, position))
+                content_length = (record.content_length_b1 << 8) + record.content_length_b0
+                start = position + self.RECORD.size
+                end = start + content_length + record.padding_length
+                if end > len(buffer):
+                    break
+                self._handle_record(record, bytes(buffer[start:start + content_length]))
+                position = end
+            del buffer[:position]
+        
+        def setup(self):
+            if self.request.family in (socket.AF_INET, socket.AF_INET6):
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         
         def handle(self):
             self.requests = {}
-            poller = select.epoll()
-            poller.register(self.rfile, select.EPOLLIN | select.EPOLLPRI)
-            while not self.server._BaseServer__shutdown_request:
-                # for fd, event in poller.poll(0.5): # Why does this not work?
-                record = self._Record(*self.RECORD.unpack(self.rfile.read(self.RECORD.size)))
-                request_id = (record.request_id_b1 << 8) + record.request_id_b0
-                content_length = (record.content_length_b1 << 8) + record.content_length_b0
-                content = self.rfile.read(content_length)
-                self.rfile.read(record.padding_length)
-                if record.type == self.BEGIN_REQUEST:
-                    self._begin_request(request_id, content)
-                else:
-                    if request_id in self.requests:
-                        self.requests[request_id].handle_record(record, content)
+            self.requests_lock = threading.Lock()
+            self.lock = threading.Lock()
+            self.broken = False
+            self.idle_since = time.monotonic()
+            buffer = bytearray()
+            self.server.metrics.connection_opened()
+            try:
+                with selectors.DefaultSelector() as selector:
+                    selector.register(self.request, selectors.EVENT_READ)
+                    while not (self.server.draining and not self.requests):
+                        if not selector.select(0.5):
+                            idle_since = self.idle_since
+                            if idle_since is not None and time.monotonic() - idle_since > self.server.idle_timeout:
+                                break
+                            continue
+                        try:
+                            data = self.request.recv(self.RECV_SIZE)
+                        except OSError:
+                            break
+                        if not data:
+                            break
+                        self.server.metrics.received(len(data))
+                        buffer += data
+                        self._handle_records(buffer)
+            finally:
+                self.server.metrics.connection_closed()
+                self.server.connection_closed(self)
+                self.broken = True
+                for request in list(self.requests.values()):
+                    request.cancel()
+                    if not request.running:
+                        self.requests.pop(request.request_id, None)
+                        request.close()
 
-    def __init__(self, host, port, application, reuseaddr=False):
+    def __init__(self, host, port, application, reuseaddr=False, mode=None, fd=None, workers=16, queue_size=64, queue_timeout=None, connections=64, spool_size=1 << 20, max_body_size=None, output_size=_Handler.RECORD_CONTENT, idle_timeout=60, max_idle_connections=None, metrics=None, metrics_path=None, stderr=False):
         self.application = application
+        self.metrics = Metrics() if metrics is None else metrics
+        self.metrics_path = metrics_path
         self.allow_reuse_address = reuseaddr
-        super().__init__((host, port), self._Handler)
+        self.stderr = stderr
+        self.idle_timeout = idle_timeout
+        self.max_idle_connections = max_idle_connections
+        self.idle_connections = collections.OrderedDict()
+        self.idle_lock = threading.Lock()
+        self.output_size = output_size
+        self.spool_size = spool_size
+        self.max_body_size = max_body_size
+        self.pool = WorkerPool(workers, queue_size, queue_timeout)
+        self.connection_pool = WorkerPool(connections)
+        self.listen(host, port, self._Handler, mode, fd)
+    
+    def connection_idle(self, handler):
+        with self.idle_lock:
+            self.idle_connections[handler] = None
+            self.idle_connections.move_to_end(handler)
+            if self.max_idle_connections is not None and len(self.idle_connections) > self.max_idle_connections:
+                oldest, _ = self.idle_connections.popitem(last=False)
+                oldest.close()
+    
+    def connection_busy(self, handler):
+        with self.idle_lock:
+            self.idle_connections.pop(handler, None)
+    
+    def connection_closed(self, handler):
+        with self.idle_lock:
+            self.idle_connections.pop(handler, None)
+    
+    def drain(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.draining = True
+        with self.idle_lock:
+            idle = list(self.idle_connections)
+        for handler in idle:
+            handler.close()
+        if not super().drain(timeout):
+            return False
+        return self.pool.wait_idle(None if deadline is None else max(0, deadline - time.monotonic()))
+    
+    def serve_forever(self, poll_interval=0.5):
+        self.pool.start()
+        super().serve_forever(poll_interval)
+    
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
 
 if __name__ == '__main__':
     from wsgiref.simple_server import demo_app
-
-    fcgi_server = FCGIServer('0.0.0.0', 8888, demo_app, True)
-    fcgi_server.serve_forever()
\ No newline at end of file
+    
+    from wsgibackends.graceful import Graceful
+    from wsgibackends.listen import listen_fds
+    
+    fds = listen_fds()
+    fcgi_server = FCGIServer('0.0.0.0', 8888, demo_app, True, fd=fds[0] if fds else None)
+    Graceful(fcgi_server).serve_forever()
\ No newline at end of file
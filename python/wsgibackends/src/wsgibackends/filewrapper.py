@@ -0,0 +1,81 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2012, Maximilian Köhl <linuxmaxi@googlemail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import io
+import os
+import stat
+
+class FileWrapper():
+    SENDFILE_SIZE = 1 << 20
+    
+    def __init__(self, filelike, blksize=8192, offset=None, length=None):
+        self.filelike = filelike
+        self.blksize = blksize
+        self.offset = offset
+        self.length = length
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+    
+    def fileno(self):
+        try:
+            fd = self.filelike.fileno()
+            if stat.S_ISREG(os.fstat(fd).st_mode):
+                return fd
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            pass
+        return None
+    
+    def __iter__(self):
+        if self.offset is not None:
+            self.filelike.seek(self.offset)
+        remaining = self.length
+        while remaining is None or remaining > 0:
+            size = self.blksize if remaining is None else min(self.blksize, remaining)
+            data = self.filelike.read(size)
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+    
+    def _range(self):
+        fd = self.fileno()
+        if fd is None:
+            return None, None, None
+        offset = self.filelike.tell() if self.offset is None else self.offset
+        count = max(0, os.fstat(fd).st_size - offset)
+        if self.length is not None:
+            count = min(count, self.length)
+        return fd, offset, count
+    
+    def size(self):
+        return self._range()[2]
+    
+    def sendfile(self, sock):
+        fd, offset, count = self._range()
+        if fd is None:
+            return None
+        total = 0
+        while count > 0:
+            sent = os.sendfile(sock.fileno(), fd, offset, min(count, self.SENDFILE_SIZE))
+            if not sent:
+                break
+            offset += sent
+            count -= sent
+            total += sent
+        return total
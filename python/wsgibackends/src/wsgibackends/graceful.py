@@ -0,0 +1,88 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2012, Maximilian Köhl <linuxmaxi@googlemail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import signal
+import sys
+import threading
+import traceback
+
+from wsgibackends.listen import SD_LISTEN_FDS_START
+
+def reexec(listener=None):
+    pid = os.fork()
+    if pid:
+        return pid
+    try:
+        os.environ.pop('LISTEN_FDNAMES', None)
+        if listener is None:
+            os.environ.pop('LISTEN_PID', None)
+            os.environ.pop('LISTEN_FDS', None)
+        else:
+            os.dup2(listener.fileno(), SD_LISTEN_FDS_START)
+            os.set_inheritable(SD_LISTEN_FDS_START, True)
+            os.environ['LISTEN_PID'] = str(os.getpid())
+            os.environ['LISTEN_FDS'] = '1'
+        argv = getattr(sys, 'orig_argv', None) or [sys.executable] + sys.argv
+        os.execv(sys.executable, [sys.executable] + argv[1:])
+    except Exception:
+        traceback.print_exc()
+    finally:
+        os._exit(1)
+
+class Graceful():
+    def __init__(self, server, timeout=30, reload=True):
+        self.server = server
+        self.timeout = timeout
+        self.reload = reload
+        self.reloading = False
+        self.stopping = False
+    
+    def stop(self):
+        if not self.stopping:
+            self.stopping = True
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+    
+    def _stop(self, signum, frame):
+        self.stop()
+    
+    def _reload(self, signum, frame):
+        self.reloading = True
+        self.stop()
+    
+    def install(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        if self.reload:
+            signal.signal(signal.SIGHUP, self._reload)
+            signal.signal(signal.SIGUSR2, self._reload)
+        else:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    
+    def serve_forever(self):
+        self.install()
+        try:
+            self.server.serve_forever()
+        finally:
+            if self.reloading:
+                reexec(self.server.socket)
+                self.server.unlink = None
+            self.server.socket.close()
+            if not self.server.drain(self.timeout):
+                print('graceful: in-flight requests did not finish within {} seconds'.format(self.timeout), file=sys.stderr)
+            self.server.server_close()
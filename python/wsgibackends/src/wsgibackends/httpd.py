@@ -0,0 +1,495 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2012, Maximilian Köhl <linuxmaxi@googlemail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import email.utils
+import io
+import selectors
+import socket
+import socketserver
+import struct
+import time
+import traceback
+import urllib.parse
+
+from wsgibackends.environ import EnvironMixIn
+from wsgibackends.filewrapper import FileWrapper
+from wsgibackends.listen import ListenMixIn
+from wsgibackends.metrics import Metrics
+from wsgibackends.pool import PoolMixIn, WorkerPool
+
+_date = [None, None]
+
+def _http_date():
+    now = int(time.time())
+    if _date[0] != now:
+        _date[:] = [now, email.utils.formatdate(now, usegmt=True)]
+    return _date[1]
+
+class HTTPServer(ListenMixIn, EnvironMixIn, PoolMixIn, socketserver.TCPServer):
+    file_wrapper = FileWrapper
+    input_terminated = True
+    
+    class _Handler(socketserver.BaseRequestHandler):
+        RECV_SIZE = 65536
+        MAX_HEADER_SIZE = 65536
+        DRAIN_SIZE = 1 << 20
+        IDLE_POLL = 0.1
+        
+        VERSIONS = ('HTTP/1.0', 'HTTP/1.1')
+        HOP_BY_HOP = ('connection', 'keep-alive', 'transfer-encoding')
+        
+        class _Body(io.RawIOBase):
+            def __init__(self, handler, length, chunked, expect):
+                self.handler = handler
+                self.remaining = length
+                self.chunked = chunked
+                self.expect = expect
+                self.total = 0
+                self.done = not chunked and not length
+                self.error = None
+            
+            def readable(self):
+                return True
+            
+            def readinto(self, buffer):
+                if self.error is not None:
+                    raise ValueError(self.error)
+                if self.done or not len(buffer):
+                    return 0
+                try:
+                    return self._readinto(buffer)
+                except ValueError as error:
+                    self.error = str(error)
+                    raise
+            
+            def _readinto(self, buffer):
+                handler = self.handler
+                if self.expect:
+                    self.expect = False
+                    handler._sendmsg([b'HTTP/1.1 100 Continue\r\n\r\n'])
+                if self.chunked and not self.remaining:
+                    self.remaining = handler._chunk_size()
+                    if not self.remaining:
+                        handler._trailers()
+                        self.done = True
+                        return 0
+                    self.total += self.remaining
+                    max_body_size = handler.server.max_body_size
+                    if max_body_size is not None and self.total > max_body_size:
+                        raise ValueError('413 Request Entity Too Large')
+                size = handler._read_into(buffer, min(len(buffer), self.remaining))
+                self.remaining -= size
+                if not self.remaining:
+                    if self.chunked:
+                        handler._crlf()
+                    else:
+                        self.done = True
+                return size
+        
+        class _Response():
+            def __init__(self, handler, method, version, keep_alive):
+                self.handler = handler
+                self.method = method
+                self.version = version
+                self.keep_alive = keep_alive
+                self.status = None
+                self.headers = None
+                self.length = None
+                self.total = None
+                self.remaining = None
+                self.chunked = False
+                self.sent = False
+            
+            def start_response(self, status, headers, exc_info=None):
+                if exc_info is not None:
+                    try:
+                        if self.sent:
+                            raise exc_info[1].with_traceback(exc_info[2])
+                    finally:
+                        exc_info = None
+                self.status = status
+                self.headers = headers
+                self.length = None
+                for name, value in headers:
+                    name = name.lower()
+                    if name == 'content-length':
+                        self.length = int(value)
+                    elif name == 'connection' and value.lower() == 'close':
+                        self.keep_alive = False
+                return self.write
+            
+            def empty(self):
+                code = self.status[:3]
+                return code in ('204', '304') or code.startswith('1')
+            
+            def bodyless(self):
+                return self.method == 'HEAD' or self.empty()
+            
+            def _head(self, buffers):
+                if self.status is None:
+                    raise AssertionError('start_response() was not called')
+                lines = ['HTTP/1.1 ' + self.status]
+                lines.extend('{}: {}'.format(name, value) for name, value in self.headers if name.lower() not in self.handler.HOP_BY_HOP)
+                if self.length is None and not self.empty():
+                    if self.total is not None:
+                        self.length = self.total
+                        lines.append('Content-Length: {}'.format(self.total))
+                    elif self.method == 'HEAD':
+                        pass
+                    elif self.version == 'HTTP/1.1':
+                        self.chunked = True
+                        lines.append('Transfer-Encoding: chunked')
+                    else:
+                        self.keep_alive = False
+                lines.append('Date: ' + _http_date())
+                if not self.keep_alive:
+                    lines.append('Connection: close')
+                elif self.version == 'HTTP/1.0':
+                    lines.append('Connection: keep-alive')
+                self.remaining = None if self.bodyless() else self.length
+                self.sent = True
+                buffers.append(('\r\n'.join(lines) + '\r\n\r\n').encode('latin1'))
+            
+            def write(self, chunk):
+                if not chunk:
+                    return
+                buffers = []
+                if not self.sent:
+                    self._head(buffers)
+                if not self.bodyless():
+                    if self.remaining is not None:
+                        if len(chunk) > self.remaining:
+                            chunk = chunk[:self.remaining]
+                            self.keep_alive = False
+                        self.remaining -= len(chunk)
+                    if self.chunked:
+                        buffers.extend((b'%x\r\n' % len(chunk), chunk, b'\r\n'))
+                    else:
+                        buffers.append(chunk)
+                if buffers:
+                    self.handler._sendmsg(buffers)
+            
+            def sendfile(self, wrapper):
+                buffers = []
+                self._head(buffers)
+                self.handler._sendmsg(buffers, getattr(socket, 'MSG_MORE', 0))
+                sent = wrapper.sendfile(self.handler.request)
+                self.handler.server.metrics.sent(sent)
+                self.remaining -= sent
+            
+            def finish(self):
+                buffers = []
+                if not self.sent:
+                    if self.total is None:
+                        self.total = 0
+                    self._head(buffers)
+                elif self.chunked:
+                    buffers.append(b'0\r\n\r\n')
+                if self.remaining:
+                    self.keep_alive = False
+                if buffers:
+                    self.handler._sendmsg(buffers)
+        
+        def _recv(self):
+            try:
+                data = self.request.recv(self.RECV_SIZE)
+            except OSError:
+                self.broken = True
+                raise
+            if not data:
+                self.broken = True
+                raise EOFError()
+            self.server.metrics.received(len(data))
+            self.buffer += data
+        
+        def _read_into(self, buffer, size):
+            if self.buffer:
+                size = min(size, len(self.buffer))
+                buffer[:size] = self.buffer[:size]
+                del self.buffer[:size]
+                return size
+            try:
+                size = self.request.recv_into(buffer, size)
+            except OSError:
+                self.broken = True
+                raise
+            if not size:
+                self.broken = True
+                raise EOFError()
+            self.server.metrics.received(size)
+            return size
+        
+        def _line(self, limit):
+            while True:
+                end = self.buffer.find(b'\r\n')
+                if end >= 0:
+                    line = bytes(self.buffer[:end])
+                    del self.buffer[:end + 2]
+                    return line
+                if len(self.buffer) > limit:
+                    raise ValueError('400 Bad Request')
+                self._recv()
+        
+        def _chunk_size(self):
+            size = self._line(1024).split(b';', 1)[0].strip()
+            if not size or size.strip(b'0123456789abcdefABCDEF'):
+                raise ValueError('400 Bad Request')
+            return int(size, 16)
+        
+        def _crlf(self):
+            if self._line(2):
+                raise ValueError('400 Bad Request')
+        
+        def _trailers(self):
+            while self._line(self.MAX_HEADER_SIZE):
+                pass
+        
+        def _sendmsg(self, buffers, flags=0):
+            try:
+                while buffers:
+                    sent = self.request.sendmsg(buffers, (), flags)
+                    self.server.metrics.sent(sent)
+                    while sent:
+                        if sent >= len(buffers[0]):
+                            sent -= len(buffers.pop(0))
+                        else:
+                            buffers[0] = memoryview(buffers[0])[sent:]
+                            sent = 0
+            except OSError:
+                self.broken = True
+                raise
+        
+        def _error(self, status):
+            body = status.encode('latin1')
+            head = 'HTTP/1.1 {}\r\nContent-Type: text/plain\r\nContent-Length: {}\r\nDate: {}\r\nConnection: close\r\n\r\n'.format(status, len(body), _http_date())
+            try:
+                self._sendmsg([head.encode('latin1'), body])
+            except OSError:
+                pass
+        
+        def _read_request(self):
+            while True:
+                while self.buffer.startswith(b'\r\n'):
+                    del self.buffer[:2]
+                end = self.buffer.find(b'\r\n\r\n')
+                if end >= 0:
+                    break
+                if len(self.buffer) > self.MAX_HEADER_SIZE:
+                    raise ValueError('431 Request Header Fields Too Large')
+                self._recv()
+            if end > self.MAX_HEADER_SIZE:
+                raise ValueError('431 Request Header Fields Too Large')
+            with memoryview(self.buffer) as view:
+                lines = str(view[:end], 'latin1').split('\r\n')
+            del self.buffer[:end + 4]
+            parts = lines[0].split(' ')
+            if len(parts) != 3:
+                raise ValueError('400 Bad Request')
+            method, target, version = parts
+            if version not in self.VERSIONS:
+                raise ValueError('505 HTTP Version Not Supported' if version.startswith('HTTP/') else '400 Bad Request')
+            if target.startswith(('http://', 'https://')):
+                url = urllib.parse.urlsplit(target)
+                path, query = url.path or '/', url.query
+            else:
+                path, _, query = target.partition('?')
+            server = self.server
+            environ = {'REQUEST_METHOD': method,
+                       'SCRIPT_NAME': '',
+                       'PATH_INFO': urllib.parse.unquote_to_bytes(path).decode('latin1'),
+                       'QUERY_STRING': query,
+                       'REQUEST_URI': target,
+                       'SERVER_PROTOCOL': version,
+                       'SERVER_NAME': server.server_name,
+                       'SERVER_PORT': server.server_port,
+                       'REMOTE_ADDR': self.remote_addr,
+                       'REMOTE_PORT': self.remote_port}
+            for line in lines[1:]:
+                name, colon, value = line.partition(':')
+                if not colon or not name or name[0] in ' \t' or name[-1] in ' \t':
+                    raise ValueError('400 Bad Request')
+                if '_' in name:
+                    continue
+                key = name.upper().replace('-', '_')
+                if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                    key = 'HTTP_' + key
+                value = value.strip(' \t')
+                if key in environ:
+                    value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+                environ[key] = value
+            length, chunked = 0, False
+            if 'HTTP_TRANSFER_ENCODING' in environ:
+                if 'CONTENT_LENGTH' in environ:
+                    raise ValueError('400 Bad Request')
+                if environ['HTTP_TRANSFER_ENCODING'].lower() != 'chunked':
+                    raise ValueError('501 Not Implemented')
+                chunked = True
+            elif 'CONTENT_LENGTH' in environ:
+                value = environ['CONTENT_LENGTH']
+                if not value.isascii() or not value.isdigit():
+                    raise ValueError('400 Bad Request')
+                length = int(value)
+                if server.max_body_size is not None and length > server.max_body_size:
+                    raise ValueError('413 Request Entity Too Large')
+            expect = environ.get('HTTP_EXPECT')
+            if expect is not None and expect.lower() != '100-continue':
+                raise ValueError('417 Expectation Failed')
+            connection = environ.get('HTTP_CONNECTION', '').lower()
+            if version == 'HTTP/1.1':
+                keep_alive = 'close' not in connection
+            else:
+                keep_alive = 'keep-alive' in connection
+            body = self._Body(self, length, chunked, expect is not None and version == 'HTTP/1.1')
+            return environ, body, keep_alive
+        
+        def _drain(self, body):
+            if body.done:
+                return True
+            if body.expect:
+                return False
+            scratch = bytearray(self.RECV_SIZE)
+            drained = 0
+            try:
+                while not body.done and drained < self.DRAIN_SIZE:
+                    drained += body.readinto(scratch)
+            except (ValueError, EOFError, OSError):
+                return False
+            return body.done
+        
+        def _handle_request(self):
+            server = self.server
+            metrics = server.metrics
+            try:
+                environ, body, keep_alive = self._read_request()
+            except ValueError as error:
+                self._error(str(error))
+                return False
+            keep_alive = keep_alive and not server.draining and server.connection_pool.queue.empty()
+            response = self._Response(self, environ['REQUEST_METHOD'], environ['SERVER_PROTOCOL'], keep_alive)
+            environ = server.make_environ(environ, io.BufferedReader(body))
+            application = server.application
+            if server.metrics_path is not None and environ['PATH_INFO'] == server.metrics_path:
+                application = metrics.application
+            metrics.request_started()
+            started = time.monotonic()
+            try:
+                result = application(environ, response.start_response)
+                try:
+                    if isinstance(result, (list, tuple)):
+                        response.total = sum(map(len, result))
+                    elif isinstance(result, FileWrapper) and response.status is not None:
+                        size = result.size()
+                        if size is not None and response.length in (None, size):
+                            response.total = size
+                            if not response.bodyless():
+                                response.sendfile(result)
+                            result.close()
+                            result = ()
+                    for chunk in result:
+                        response.write(chunk)
+                    response.finish()
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+                return response.keep_alive and self._drain(body)
+            except Exception:
+                if body.error is not None:
+                    if not response.sent:
+                        response.status = body.error
+                        self._error(response.status)
+                elif not self.broken:
+                    traceback.print_exc()
+                    if not response.sent:
+                        response.status = '500 Internal Server Error'
+                        self._error(response.status)
+                return False
+            finally:
+                environ['wsgi.errors'].flush()
+                metrics.request_finished(response.status.split(' ', 1)[0] if response.status else None, time.monotonic() - started)
+        
+        def _wait(self, selector, idle):
+            server = self.server
+            deadline = time.monotonic() + server.idle_timeout
+            while not self.buffer:
+                remaining = deadline - time.monotonic()
+                if server.draining or remaining <= 0 or (idle and not server.connection_pool.queue.empty()):
+                    return False
+                if selector.select(min(self.IDLE_POLL, remaining)):
+                    return True
+            return True
+        
+        def setup(self):
+            self.buffer = bytearray()
+            self.broken = False
+            if isinstance(self.client_address, tuple):
+                self.remote_addr, self.remote_port = str(self.client_address[0]), str(self.client_address[1])
+            else:
+                self.remote_addr, self.remote_port = '', ''
+            if self.request.family in (socket.AF_INET, socket.AF_INET6):
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.server.request_timeout is not None:
+                self.request.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack('ll', int(self.server.request_timeout), 0))
+        
+        def handle(self):
+            metrics = self.server.metrics
+            metrics.connection_opened()
+            try:
+                with selectors.DefaultSelector() as selector:
+                    selector.register(self.request, selectors.EVENT_READ)
+                    idle = False
+                    while self._wait(selector, idle) and self._handle_request():
+                        idle = True
+            except (EOFError, OSError):
+                pass
+            finally:
+                metrics.connection_closed()
+    
+    def __init__(self, host, port, application, reuseaddr=False, mode=None, fd=None, workers=16, queue_size=64, queue_timeout=None, idle_timeout=5, request_timeout=30, max_body_size=None, metrics=None, metrics_path=None):
+        self.application = application
+        self.metrics = Metrics() if metrics is None else metrics
+        self.metrics_path = metrics_path
+        self.allow_reuse_address = reuseaddr
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        self.max_body_size = max_body_size
+        self.connection_pool = WorkerPool(workers, queue_size, queue_timeout)
+        self.listen(host, port, self._Handler, mode, fd)
+        if isinstance(self.server_address, tuple):
+            self.server_name, self.server_port = str(self.server_address[0]), str(self.server_address[1])
+        else:
+            self.server_name, self.server_port = str(self.server_address), ''
+    
+    def dequeued(self, wait):
+        self.metrics.request_dequeued(wait)
+    
+    def reject_request(self, request, client_address):
+        try:
+            request.sendall(b'HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/plain\r\nContent-Length: 23\r\nConnection: close\r\n\r\n503 Service Unavailable')
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+if __name__ == '__main__':
+    from wsgiref.simple_server import demo_app
+    
+    from wsgibackends.graceful import Graceful
+    from wsgibackends.listen import listen_fds
+    
+    fds = listen_fds()
+    http_server = HTTPServer('0.0.0.0', 8080, demo_app, True, fd=fds[0] if fds else None)
+    Graceful(http_server).serve_forever()
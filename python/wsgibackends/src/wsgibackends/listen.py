@@ -0,0 +1,78 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2012, Maximilian Köhl <linuxmaxi@googlemail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import socket
+import stat
+
+SD_LISTEN_FDS_START = 3
+
+def listen_fds(unset=True):
+    try:
+        if int(os.environ.get('LISTEN_PID', '')) != os.getpid():
+            return []
+        count = int(os.environ.get('LISTEN_FDS', ''))
+    except ValueError:
+        return []
+    finally:
+        if unset:
+            for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+                os.environ.pop(name, None)
+    return list(range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + count))
+
+class ListenMixIn():
+    request_queue_size = socket.SOMAXCONN
+    mode = None
+    unlink = None
+    
+    def listen(self, host, port, handler, mode=None, fd=None):
+        self.mode = mode
+        if fd is not None:
+            listener = socket.socket(fileno=fd)
+            self.address_family = listener.family
+            super().__init__(listener.getsockname(), handler, bind_and_activate=False)
+            self.socket.close()
+            self.socket = listener
+        elif port is None:
+            self.address_family = socket.AF_UNIX
+            super().__init__(host, handler)
+        else:
+            super().__init__((host, port), handler)
+    
+    def server_bind(self):
+        if self.address_family != socket.AF_UNIX:
+            super().server_bind()
+            return
+        try:
+            if stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+                os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+        super().server_bind()
+        self.unlink = self.server_address
+        if self.mode is not None:
+            os.chmod(self.server_address, self.mode)
+    
+    def server_close(self):
+        super().server_close()
+        if self.unlink is not None:
+            try:
+                os.unlink(self.unlink)
+            except FileNotFoundError:
+                pass
+            self.unlink = None
@@ -0,0 +1,146 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2012, Maximilian Köhl <linuxmaxi@googlemail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import bisect
+import collections
+import socketserver
+import threading
+
+from wsgibackends.listen import ListenMixIn
+
+class Histogram():
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def snapshot(self):
+        cumulative, total = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'buckets': cumulative, 'sum': self.sum, 'count': self.count}
+
+class Metrics():
+    def __init__(self, prefix='wsgibackends'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.active_connections = 0
+        self.connections_total = 0
+        self.inflight_requests = 0
+        self.requests_total = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.statuses = collections.Counter()
+        self.queue_wait = Histogram()
+        self.app_time = Histogram()
+    
+    def connection_opened(self):
+        with self.lock:
+            self.active_connections += 1
+            self.connections_total += 1
+    
+    def connection_closed(self):
+        with self.lock:
+            self.active_connections -= 1
+    
+    def request_started(self):
+        with self.lock:
+            self.inflight_requests += 1
+            self.requests_total += 1
+    
+    def request_finished(self, status=None, app_time=None):
+        with self.lock:
+            self.inflight_requests -= 1
+            if status is not None:
+                self.statuses[status] += 1
+            if app_time is not None:
+                self.app_time.observe(app_time)
+    
+    def request_dequeued(self, wait):
+        with self.lock:
+            self.queue_wait.observe(wait)
+    
+    def received(self, length):
+        with self.lock:
+            self.bytes_received += length
+    
+    def sent(self, length):
+        with self.lock:
+            self.bytes_sent += length
+    
+    def snapshot(self):
+        with self.lock:
+            return {'active_connections': self.active_connections,
+                    'connections_total': self.connections_total,
+                    'inflight_requests': self.inflight_requests,
+                    'requests_total': self.requests_total,
+                    'bytes_received': self.bytes_received,
+                    'bytes_sent': self.bytes_sent,
+                    'statuses': dict(self.statuses),
+                    'queue_wait': self.queue_wait.snapshot(),
+                    'app_time': self.app_time.snapshot()}
+    
+    def render(self):
+        snapshot, lines = self.snapshot(), []
+        
+        def metric(name, type, value, labels=''):
+            lines.append('# TYPE {}_{} {}'.format(self.prefix, name, type))
+            lines.append('{}_{}{} {}'.format(self.prefix, name, labels, value))
+        
+        metric('active_connections', 'gauge', snapshot['active_connections'])
+        metric('connections_total', 'counter', snapshot['connections_total'])
+        metric('inflight_requests', 'gauge', snapshot['inflight_requests'])
+        metric('requests_total', 'counter', snapshot['requests_total'])
+        metric('received_bytes_total', 'counter', snapshot['bytes_received'])
+        metric('sent_bytes_total', 'counter', snapshot['bytes_sent'])
+        lines.append('# TYPE {}_responses_total counter'.format(self.prefix))
+        for status, count in sorted(snapshot['statuses'].items()):
+            lines.append('{}_responses_total{{status="{}"}} {}'.format(self.prefix, status, count))
+        for name in ('queue_wait', 'app_time'):
+            histogram = snapshot[name]
+            lines.append('# TYPE {}_{}_seconds histogram'.format(self.prefix, name))
+            for bound, count in histogram['buckets']:
+                lines.append('{}_{}_seconds_bucket{{le="{}"}} {}'.format(self.prefix, name, '+Inf' if bound == float('inf') else bound, count))
+            lines.append('{}_{}_seconds_sum {}'.format(self.prefix, name, histogram['sum']))
+            lines.append('{}_{}_seconds_count {}'.format(self.prefix, name, histogram['count']))
+        return '\n'.join(lines) + '\n'
+    
+    def application(self, environ, start_response):
+        body = self.render().encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'), ('Content-Length', str(len(body)))])
+        return [body]
+
+class MetricsServer(ListenMixIn, socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    
+    class _Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            self.request.sendall(self.server.metrics.render().encode('utf-8'))
+    
+    def __init__(self, host, port, metrics, mode=None, fd=None):
+        self.metrics = metrics
+        self.listen(host, port, self._Handler, mode, fd)
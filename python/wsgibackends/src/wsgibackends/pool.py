@@ -0,0 +1,132 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2012, Maximilian Köhl <linuxmaxi@googlemail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import queue
+import threading
+import time
+import traceback
+
+class WorkerPool():
+    def __init__(self, workers=16, queue_size=0, queue_timeout=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.pid = None
+        self.threads = []
+        self.pending = 0
+        self.idle = threading.Condition()
+    
+    def start(self):
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+        self.threads = []
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+    
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            function, args, expire, queued = task
+            try:
+                if self.queue_timeout is not None and time.monotonic() - queued > self.queue_timeout:
+                    if expire is not None:
+                        expire(*args)
+                else:
+                    function(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.release()
+    
+    def acquire(self):
+        if self.pid != os.getpid():
+            self.start()
+        if not self.slots.acquire(blocking=False):
+            return False
+        with self.idle:
+            self.pending += 1
+        return True
+    
+    def release(self):
+        with self.idle:
+            self.pending -= 1
+            if not self.pending:
+                self.idle.notify_all()
+        self.slots.release()
+    
+    def wait_idle(self, timeout=None):
+        with self.idle:
+            return self.idle.wait_for(lambda: not self.pending, timeout)
+    
+    def submit(self, function, *args, expire=None):
+        if self.pid != os.getpid():
+            self.start()
+        self.queue.put((function, args, expire, time.monotonic()))
+    
+    def shutdown(self, wait=True):
+        for thread in self.threads:
+            self.queue.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+class PoolMixIn():
+    draining = False
+    
+    def process_request(self, request, client_address):
+        if not self.connection_pool.acquire():
+            self.reject_request(request, client_address)
+            return
+        self.connection_pool.submit(self.process_request_thread, request, client_address, time.monotonic(), expire=self._expire_request)
+    
+    def _expire_request(self, request, client_address, queued):
+        self.reject_request(request, client_address)
+    
+    def process_request_thread(self, request, client_address, queued):
+        self.dequeued(time.monotonic() - queued)
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+    
+    def reject_request(self, request, client_address):
+        self.shutdown_request(request)
+    
+    def dequeued(self, wait):
+        pass
+    
+    def drain(self, timeout=None):
+        self.draining = True
+        return self.connection_pool.wait_idle(timeout)
+    
+    def serve_forever(self, poll_interval=0.5):
+        self.connection_pool.start()
+        super().serve_forever(poll_interval)
+    
+    def server_close(self):
+        self.draining = True
+        super().server_close()
+        self.connection_pool.shutdown(wait=False)
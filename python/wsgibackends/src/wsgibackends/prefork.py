@@ -0,0 +1,118 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2012, Maximilian Köhl <linuxmaxi@googlemail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from wsgibackends.graceful import Graceful, reexec
+
+class Prefork():
+    RESTART_DELAY = 1
+    
+    def __init__(self, server, processes=None, reuseport=False, timeout=30):
+        self.server = server
+        self.timeout = timeout
+        self.server.multiprocess = True
+        self.processes = processes or os.cpu_count() or 1
+        self.reuseport = reuseport
+        self.children = {}
+        self.running = False
+    
+    def _bind(self):
+        server = self.server
+        listener = socket.socket(server.address_family, server.socket_type)
+        if server.allow_reuse_address:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind(server.server_address)
+        listener.listen(server.request_queue_size)
+        server.socket = listener
+    
+    def _child(self):
+        signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+        self.server.unlink = None
+        status = 0
+        try:
+            if self.reuseport:
+                self._bind()
+            Graceful(self.server, self.timeout, reload=False).serve_forever()
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+    
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            self._child()
+        self.children[pid] = time.monotonic()
+    
+    def _stop(self, signum, frame):
+        self.running = False
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    
+    def _reload(self, signum, frame):
+        if not self.running:
+            return
+        if self.reuseport:
+            print('prefork: reload requires a shared listening socket', file=sys.stderr)
+            return
+        reexec(self.server.socket)
+        self.server.unlink = None
+        self._stop(signum, frame)
+    
+    def serve_forever(self):
+        self.running = True
+        if self.reuseport:
+            self.server.socket.close()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+        signal.signal(signal.SIGUSR2, self._reload)
+        try:
+            while self.running or self.children:
+                while self.running and len(self.children) < self.processes:
+                    self._spawn()
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    self.children.clear()
+                    continue
+                started = self.children.pop(pid, None)
+                if self.running and started is not None and time.monotonic() - started < self.RESTART_DELAY:
+                    time.sleep(self.RESTART_DELAY)
+        finally:
+            self.server.server_close()
+
+if __name__ == '__main__':
+    from wsgiref.simple_server import demo_app
+    
+    from wsgibackends.fcgi import FCGIServer
+    from wsgibackends.listen import listen_fds
+    
+    fds = listen_fds()
+    Prefork(FCGIServer('0.0.0.0', 8888, demo_app, True, fd=fds[0] if fds else None)).serve_forever()
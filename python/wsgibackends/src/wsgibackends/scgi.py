@@ -16,47 +16,197 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import io
+import socket
 import socketserver
-import wsgiref.util
+import time
 
-class SCGIServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+from wsgibackends.filewrapper import FileWrapper
+from wsgibackends.environ import EnvironMixIn
+from wsgibackends.listen import ListenMixIn
+from wsgibackends.metrics import Metrics
+from wsgibackends.pool import PoolMixIn, WorkerPool
+
+class SCGIServer(ListenMixIn, EnvironMixIn, PoolMixIn, socketserver.TCPServer):
+    file_wrapper = FileWrapper
+    
     class _Handler(socketserver.BaseRequestHandler):
+        RECV_SIZE = 65536
+        
+        class _Body(io.RawIOBase):
+            def __init__(self, sock, prefix, length, metrics):
+                self.sock = sock
+                self.metrics = metrics
+                self.prefix = memoryview(prefix)
+                self.remaining = length
+            
+            def readable(self):
+                return True
+            
+            def readinto(self, buffer):
+                size = min(len(buffer), self.remaining)
+                if not size:
+                    return 0
+                if self.prefix:
+                    size = min(size, len(self.prefix))
+                    buffer[:size] = self.prefix[:size]
+                    self.prefix = self.prefix[size:]
+                else:
+                    size = self.sock.recv_into(buffer, size)
+                    self.metrics.received(size)
+                self.remaining -= size
+                return size
+        
+        def _recv(self, buffer):
+            data = self.request.recv(self.RECV_SIZE)
+            if not data:
+                raise EOFError()
+            self.server.metrics.received(len(data))
+            buffer += data
+        
+        def _read_headers(self):
+            buffer = bytearray()
+            colon = -1
+            while colon < 0:
+                if len(buffer) > 10:
+                    raise ValueError('invalid netstring length')
+                self._recv(buffer)
+                colon = buffer.find(b':')
+            if colon > 10 or not buffer[:colon].isdigit():
+                raise ValueError('invalid netstring length')
+            length = int(buffer[:colon])
+            if length > self.server.max_header_size:
+                raise ValueError('headers too large')
+            end = colon + 1 + length
+            while len(buffer) <= end:
+                self._recv(buffer)
+            if buffer[end] != ord(','):
+                raise ValueError('invalid netstring terminator')
+            with memoryview(buffer) as view:
+                fields = str(view[colon + 1:end], 'latin1').split('\x00')
+            return dict(zip(fields[0::2], fields[1::2])), buffer[end + 1:]
+        
+        def _sendmsg(self, buffers):
+            while buffers:
+                sent = self.request.sendmsg(buffers)
+                self.server.metrics.sent(sent)
+                while sent:
+                    if sent >= len(buffers[0]):
+                        sent -= len(buffers.pop(0))
+                    else:
+                        buffers[0] = memoryview(buffers[0])[sent:]
+                        sent = 0
+        
+        def _sendall(self, data):
+            self.request.sendall(data)
+            self.server.metrics.sent(len(data))
+        
+        def _cork(self, enabled):
+            if self.server.cork and self.request.family in (socket.AF_INET, socket.AF_INET6):
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, enabled)
+        
+        def setup(self):
+            if self.server.nodelay and self.request.family in (socket.AF_INET, socket.AF_INET6):
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        
         def handle(self):
-            length = ''
-            while not length.endswith(':'):
-                length += self.request.recv(1).decode('ascii')
-            length = int(length[:-1])
-            rfile = self.request.makefile('rb', -1)
-            wfile = self.request.makefile('wb', 0)
-            environ = rfile.read(length).decode('latin1').split('\x00')
-            environ = dict([(environ[i], environ[i + 1]) for i in range(0, len(environ) - 2, 2)])
-            environ['wsgi.errors'] = io.StringIO()
-            environ['wsgi.file_wrapper'] = wsgiref.util.FileWrapper
-            environ['wsgi.input'] = rfile
-            environ['wsgi.multiprocess'] = False
-            environ['wsgi.multithread'] = True
-            environ['wsgi.run_once'] = False
-            environ['wsgi.version'] = (1, 0)
-            if environ.get('HTTPS', 'off') in ('on', '1'):
-                environ['wsgi.url_scheme'] = 'https'
-            else:
-                environ['wsgi.url_scheme'] = 'http'
+            metrics = self.server.metrics
+            metrics.connection_opened()
+            try:
+                self._handle()
+            finally:
+                metrics.connection_closed()
+        
+        def _handle(self):
+            try:
+                environ, prefix = self._read_headers()
+            except (ValueError, EOFError):
+                return
+            length = environ.get('CONTENT_LENGTH') or '0'
+            if not length.isascii() or not length.isdigit():
+                try:
+                    self._sendall(b'Status: 400 Bad Request\r\nContent-Type: text/plain\r\n\r\n400 Bad Request')
+                except OSError:
+                    pass
+                return
+            body = self._Body(self.request, prefix, int(length), self.server.metrics)
+            environ = self.server.make_environ(environ, io.BufferedReader(body))
+            
+            pending, statuses = [], []
             
-            def start_response(status, headers):
+            def start_response(status, headers, exc_info=None):
+                if exc_info is not None:
+                    try:
+                        if statuses and not pending:
+                            raise exc_info[1].with_traceback(exc_info[2])
+                    finally:
+                        exc_info = None
+                statuses[:] = [status.split(' ', 1)[0]]
                 headers = ['{}: {}'.format(name, value) for name, value in headers] 
                 headers.append('Status: {}'.format(status))
-                wfile.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin1'))
+                pending[:] = [('\r\n'.join(headers) + '\r\n\r\n').encode('latin1')]
+                return write
+            
+            def write(chunk):
+                if not chunk:
+                    return
+                if pending:
+                    self._sendmsg([pending.pop(), chunk])
+                else:
+                    self._sendall(chunk)
             
-            for chunk in self.server.application(environ, start_response):
-                wfile.write(chunk)
+            application = self.server.application
+            if self.server.metrics_path is not None and environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '') == self.server.metrics_path:
+                application = self.server.metrics.application
+            self.server.metrics.request_started()
+            started = time.monotonic()
+            self._cork(1)
+            try:
+                result = application(environ, start_response)
+                try:
+                    if isinstance(result, FileWrapper) and result.fileno() is not None:
+                        if pending:
+                            self._sendall(pending.pop())
+                        self.server.metrics.sent(result.sendfile(self.request))
+                    else:
+                        for chunk in result:
+                            write(chunk)
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+                if pending:
+                    self._sendall(pending.pop())
+            finally:
+                environ['wsgi.errors'].flush()
+                self._cork(0)
+                self.server.metrics.request_finished(statuses[0] if statuses else None, time.monotonic() - started)
         
-    def __init__(self, host, port, application, reuseaddr=False):
+    def __init__(self, host, port, application, reuseaddr=False, mode=None, fd=None, workers=16, queue_size=64, queue_timeout=None, cork=False, nodelay=False, max_header_size=65536, metrics=None, metrics_path=None):
         self.application = application
+        self.metrics = Metrics() if metrics is None else metrics
+        self.metrics_path = metrics_path
         self.allow_reuse_address = reuseaddr
-        super().__init__((host, port), self._Handler)
+        self.cork = cork
+        self.nodelay = nodelay
+        self.max_header_size = max_header_size
+        self.connection_pool = WorkerPool(workers, queue_size, queue_timeout)
+        self.listen(host, port, self._Handler, mode, fd)
+    
+    def dequeued(self, wait):
+        self.metrics.request_dequeued(wait)
+    
+    def reject_request(self, request, client_address):
+        try:
+            request.sendall(b'Status: 503 Service Unavailable\r\nContent-Type: text/plain\r\n\r\n503 Service Unavailable')
+        except OSError:
+            pass
+        self.shutdown_request(request)
 
 if __name__ == '__main__':
     from wsgiref.simple_server import demo_app
 
-    scgi_server = SCGIServer('0.0.0.0', 8888, demo_app, True)
-    scgi_server.serve_forever()
\ No newline at end of file
+    from wsgibackends.graceful import Graceful
+    from wsgibackends.listen import listen_fds
+    
+    fds = listen_fds()
+    scgi_server = SCGIServer('0.0.0.0', 8888, demo_app, True, fd=fds[0] if fds else None)
+    Graceful(scgi_server).serve_forever()
\ No newline at end of file